@@ -2,13 +2,45 @@ import asyncio
 import sys
 
 from src.bot import Bot
+from src.LLM_API import close_llm_client
 from utils.config import ConfigManager
 from utils.logger import LoggerManager
 from src.napcat_adapter import Adapter
+from utils.bounded_queue import BoundedQueue
 
-global_message_queue = asyncio.Queue()
-global_send_message_queue = asyncio.Queue()
-global_response_queue = asyncio.Queue()
+# 全局队列，在main中按配置创建（有界，满时按各自的策略处理）
+global_message_queue: BoundedQueue = None
+global_send_message_queue: BoundedQueue = None
+global_response_queue: BoundedQueue = None
+
+def create_queues(cfg, log):
+    """
+    :按[queue]配置创建全局队列
+    :消息队列默认丢弃同群最旧的非@消息；设为block时暂停读取websocket（背压传导到napcat）
+    :发送队列默认block，会话发送时等待；响应队列默认丢弃最旧的响应（等待方按超时处理）
+    """
+    global global_message_queue, global_send_message_queue, global_response_queue
+    log = log.get_logger("queue")
+    global_message_queue = BoundedQueue(
+        maxsize=cfg.get("queue", "message_queue_size", 2000),
+        policy=cfg.get("queue", "message_queue_policy", "drop_oldest"),
+        name="message",
+        log=log,
+        protected=Bot.mentions_self,
+        group_of=lambda msg: msg.get("group_id"),
+    )
+    global_send_message_queue = BoundedQueue(
+        maxsize=cfg.get("queue", "send_queue_size", 1000),
+        policy=cfg.get("queue", "send_queue_policy", "block"),
+        name="send",
+        log=log,
+    )
+    global_response_queue = BoundedQueue(
+        maxsize=cfg.get("queue", "response_queue_size", 1000),
+        policy=cfg.get("queue", "response_queue_policy", "drop_oldest"),
+        name="response",
+        log=log,
+    )
 
 async def start_adapter(cfg,log):
     """模拟Adapter：无限循环运行，捕获取消信号优雅退出"""
@@ -16,14 +48,13 @@ async def start_adapter(cfg,log):
     log.info("Adapter 启动成功，开始监听消息...")
     adapter = Adapter(cfg=cfg, log=log,global_message_queue=global_message_queue,global_send_queue=global_send_message_queue,global_response_queue=global_response_queue)
     #模拟你的Adapter核心逻辑（比如WebSocket监听）
+    # start_server内部同时启动消息发送循环（出站调度的分派和指标报告只启动一份）
     server_task = asyncio.create_task(adapter.start_server())
-    send_msg_task = asyncio.create_task(adapter.get_send_msg_to_napcat())
     try:
-        await asyncio.gather(server_task,send_msg_task)
+        await server_task
     except asyncio.CancelledError:
         # 关键：捕获取消信号，执行资源清理（根据你的业务补充）
         server_task.cancel()
-        send_msg_task.cancel()
         log.info("Adapter：收到退出信号，正在清理资源（关闭WebSocket/队列）...")
     finally:
         log.info("Adapter：已优雅退出")
@@ -44,12 +75,24 @@ async def start_bot(cfg, log):
         # 关键：捕获取消信号，执行资源清理
         log.info("Bot：收到退出信号，正在清理资源（保存未处理消息）...")
     finally:
+        # 关闭共享的LLM客户端连接池
+        await close_llm_client()
         log.info("Bot：已优雅退出")
 async def main(log):
     global_cfg = ConfigManager("config.ini")
     global_logger = log
+    create_queues(cfg=global_cfg, log=global_logger)
+    # 配置热重载：修改config.ini后无需重启（如回复概率、模型）
+    watch_interval = global_cfg.get("config", "watch_interval", 2)
+    watch_task = None
+    if watch_interval > 0:
+        watch_task = asyncio.create_task(global_cfg.watch(interval=watch_interval, log=global_logger.get_logger("config")))
     #并发启动任务
-    _ = await asyncio.gather(start_bot(cfg=global_cfg,log=global_logger), start_adapter(cfg=global_cfg,log=global_logger))
+    try:
+        _ = await asyncio.gather(start_bot(cfg=global_cfg,log=global_logger), start_adapter(cfg=global_cfg,log=global_logger))
+    finally:
+        if watch_task:
+            watch_task.cancel()
 async def graceful_shutdown():
     try:
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
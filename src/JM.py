@@ -1,10 +1,79 @@
+import asyncio
 import base64
 import os
+import threading
 
 from jmcomic import *
 
+from utils.cache import TTLCache, InflightDedup
+from utils.config import ConfigManager
+
+# 进程内共享的禁漫客户端，首次搜索时创建（客户端内部复用连接与域名配置）
+_jm_client = None
+_jm_client_lock = threading.Lock()
+# 搜索/本子详情结果缓存：key为规范化后的关键字或车号，首次搜索时按配置创建
+_search_cache: TTLCache | None = None
+_search_inflight = InflightDedup()
+
+
+def get_jm_client():
+    """获取共享的禁漫客户端（线程安全，搜索在线程池中执行）"""
+    global _jm_client
+    if _jm_client is None:
+        with _jm_client_lock:
+            if _jm_client is None:
+                _jm_client = JmOption.default().new_jm_client()
+    return _jm_client
+
+
+def get_search_cache(global_cfg: ConfigManager) -> TTLCache:
+    """获取进程共享的搜索结果缓存，容量和过期时间可在[jm]节配置"""
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = TTLCache(
+            max_size=global_cfg.get("jm", "search_cache_size", 256),
+            ttl=global_cfg.get("jm", "search_cache_ttl", 3600),
+        )
+    return _search_cache
+
+
+def normalize_comic_keyword(comic_keyword: str | int) -> str | int:
+    """规范化搜索词：纯数字视为车号（转为int），其余去除首尾空白、合并连续空白并忽略大小写"""
+    if isinstance(comic_keyword, str):
+        keyword = " ".join(comic_keyword.split())
+        if keyword.upper().startswith("JM") and keyword[2:].strip().isdigit():
+            keyword = keyword[2:].strip()
+        if keyword.isdigit():
+            return int(keyword)
+        return keyword.casefold()
+    return comic_keyword
+
+
+async def search_comic_cached(comic_keyword: str | int, global_cfg: ConfigManager, max_count: int = 5) -> str:
+    """
+    :search_comic的异步缓存版本
+    :argument 结果按规范化后的关键字/车号缓存（TTL+LRU），并发的相同搜索共享一次请求，搜索本身在线程池中执行不阻塞事件循环
+    """
+    keyword = normalize_comic_keyword(comic_keyword)
+    key = (type(keyword).__name__, keyword, max_count)
+    search_cache = get_search_cache(global_cfg)
+    result = search_cache.get(key)
+    if result is not None:
+        return result
+
+    async def search():
+        text = await asyncio.to_thread(search_comic, keyword, max_count)
+        if text:
+            # 搜索失败不缓存，下次重新请求
+            search_cache.set(key, text)
+        return text
+
+    return await _search_inflight.run(key, search) or "搜索失败，请稍后再试"
+
+
 def search_comic(comic_keyword: str | int, max_count: int = 5)->str|None:
-    client = JmOption.default().new_jm_client()
+    """同步搜索（会阻塞），失败时返回None"""
+    client = get_jm_client()
     result =[]
     if isinstance(comic_keyword, str):
         # 分页查询，search_site就是禁漫网页上的【站内搜索】
@@ -12,19 +81,20 @@ def search_comic(comic_keyword: str | int, max_count: int = 5)->str|None:
             page: JmSearchPage = client.search_site(search_query=comic_keyword, page=1)
         except MissingAlbumPhotoException as e:
             print(f'id={e.error_jmid}的本子不存在')
-
+            return None
         except JsonResolveFailException as e:
             print(f'解析json失败')
             # 响应对象
             resp = e.resp
             print(f'resp.text: {resp.text}, resp.status_code: {resp.status_code}')
-
+            return None
         except RequestRetryAllFailException as e:
             print(f'请求失败，重试次数耗尽')
-
+            return None
         except JmcomicException as e:
             # 捕获所有异常，用作兜底
             print(f'jmcomic遇到异常: {e}')
+            return None
         result.append(f'结果总数: {page.total}, 分页大小: {page.page_size}，页数: {page.page_count}')
         #print(f'结果总数: {page.total}, 分页大小: {page.page_size}，页数: {page.page_count}')
 
@@ -43,19 +113,20 @@ def search_comic(comic_keyword: str | int, max_count: int = 5)->str|None:
             page = client.search_site(search_query=comic_keyword)
         except MissingAlbumPhotoException as e:
             print(f'id={e.error_jmid}的本子不存在')
-
+            return None
         except JsonResolveFailException as e:
             print(f'解析json失败')
             # 响应对象
             resp = e.resp
             print(f'resp.text: {resp.text}, resp.status_code: {resp.status_code}')
-
+            return None
         except RequestRetryAllFailException as e:
             print(f'请求失败，重试次数耗尽')
-
+            return None
         except JmcomicException as e:
             # 捕获所有异常，用作兜底
             print(f'jmcomic遇到异常: {e}')
+            return None
         album: JmAlbumDetail = page.single_album
         result.append(f"{album.name}:总页数:{album.page_count},发布日期:{album.pub_date}更新日期：{album.update_date},作者:{' and '.join(album.authors)},观看数:{album.views},评论数:{album.comment_count}")
         result.append(f"tag:{'-'.join(album.tags)}")
@@ -64,25 +135,120 @@ def search_comic(comic_keyword: str | int, max_count: int = 5)->str|None:
         return "unknown"
     return "\n".join(result)
 
-def download_comics(comic_id:int):
-    option = create_option_by_file('myoption.yml')
-    try:
-        download_album(comic_id,option)
-        pdf_path = f"file:///root/LinXiaoLu_bot/JM-pdf/{comic_id}.pdf"
+_download_options: dict = {}
+_download_options_lock = threading.Lock()
+
+
+def get_download_option(option_file: str = 'myoption.yml'):
+    """按配置文件缓存下载配置，避免每次下载都重新解析yml"""
+    option = _download_options.get(option_file)
+    if option is None:
+        with _download_options_lock:
+            option = _download_options.get(option_file)
+            if option is None:
+                option = create_option_by_file(option_file)
+                _download_options[option_file] = option
+    return option
+
+
+def get_pdf_path(comic_id: int, pdf_dir: str = "/root/LinXiaoLu_bot/JM-pdf") -> str:
+    """本子对应的pdf文件路径（与myoption.yml中img2pdf的pdf_dir一致）"""
+    return os.path.join(pdf_dir, f"{comic_id}.pdf")
+
+
+def _long_img_plugins(option) -> list[tuple[str, dict]]:
+    """option中配置的long_img插件：[(插件组如after_photo, kwargs)]"""
+    plugins = getattr(option, "plugins", None) or {}
+    plugins = getattr(plugins, "src_dict", plugins)
+    result = []
+    for group, plugin_list in plugins.items():
+        if not isinstance(plugin_list, list):
+            continue
+        for plugin_info in plugin_list:
+            if isinstance(plugin_info, dict) and plugin_info.get("plugin") == "long_img":
+                result.append((group, plugin_info.get("kwargs") or {}))
+    return result
+
+
+def get_long_img_dirs(option_file: str = 'myoption.yml') -> list[str]:
+    """long_img插件的长图存放目录（img_dir）"""
+    option = get_download_option(option_file)
+    return [kwargs["img_dir"] for _, kwargs in _long_img_plugins(option) if kwargs.get("img_dir")]
+
 
-        return pdf_path
+def get_long_img_paths(option, album) -> list[str]:
+    """
+    :按long_img插件的kwargs计算本子的长图路径，与插件的decide_filepath规则一致
+    :argument 配置了dir_rule时按dir_rule，否则为img_dir + filename_rule（如Aname为本子名）+ .png
+    """
+    paths = []
+    for group, kwargs in _long_img_plugins(option):
+        # after_photo时每个章节生成一张长图，after_album时整本一张
+        photos = list(album) if group == "after_photo" else [None]
+        for photo in photos:
+            try:
+                if kwargs.get("dir_rule") is not None:
+                    path = DirRule(**kwargs["dir_rule"]).apply_rule_to_path(album, photo)
+                else:
+                    filename = DirRule.apply_rule_to_filename(album, photo, kwargs.get("filename_rule", "Pid"))
+                    path = os.path.join(kwargs.get("img_dir") or os.getcwd(), filename + ".png")
+            except Exception as e:
+                print(f'计算长图路径失败: {e}')
+                continue
+            path = os.path.abspath(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def download_comics(comic_id:int, option_file: str = 'myoption.yml', pdf_dir: str = "/root/LinXiaoLu_bot/JM-pdf"):
+    """同步下载本子并转为pdf（会阻塞数分钟，应在线程池中调用），成功返回file://路径，失败返回None"""
+    artifacts = download_comic_artifacts(comic_id, option_file=option_file, pdf_dir=pdf_dir)
+    if artifacts is None:
+        return None
+    return f"file://{artifacts['pdf']}"
+
+
+def download_comic_artifacts(comic_id:int, option_file: str = 'myoption.yml', pdf_dir: str = "/root/LinXiaoLu_bot/JM-pdf") -> dict | None:
+    """
+    :同步下载本子，返回产物信息，失败返回None
+    :return: {"pdf": pdf路径, "extras": 插件生成的其他文件（如长图）, "image_dirs": 原始图片所在目录, "image_base_dir": 图片下载根目录}
+    """
+    option = get_download_option(option_file)
+    try:
+        album, downloader = download_album(comic_id,option)
     except MissingAlbumPhotoException as e:
         print(f'id={e.error_jmid}的本子不存在')
-
+        return None
     except JsonResolveFailException as e:
         print(f'解析json失败')
         # 响应对象
         resp = e.resp
         print(f'resp.text: {resp.text}, resp.status_code: {resp.status_code}')
-
+        return None
     except RequestRetryAllFailException as e:
         print(f'请求失败，重试次数耗尽')
-
+        return None
     except JmcomicException as e:
         # 捕获所有异常，用作兜底
         print(f'jmcomic遇到异常: {e}')
+        return None
+    pdf_path = get_pdf_path(comic_id, pdf_dir)
+    if not os.path.exists(pdf_path):
+        return None
+    # 长图：按插件配置计算路径，并合并下载器记录的导出文件（旧版jmcomic没有该接口时忽略）
+    get_export_files = getattr(downloader, "get_export_filepath_list", None)
+    extras = get_long_img_paths(option, album)
+    for path in (get_export_files("png") if get_export_files else []):
+        if os.path.abspath(path) not in extras:
+            extras.append(os.path.abspath(path))
+    extras = [path for path in extras if os.path.exists(path)]
+    image_dirs = []
+    for photo in album:
+        try:
+            image_dirs.append(option.decide_image_save_dir(photo))
+        except Exception as e:
+            print(f'获取章节图片目录失败: {e}')
+    dir_rule = getattr(option, "dir_rule", None)
+    image_base_dir = getattr(dir_rule, "base_dir", None)
+    return {"pdf": pdf_path, "extras": extras, "image_dirs": image_dirs, "image_base_dir": image_base_dir}
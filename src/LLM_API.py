@@ -1,7 +1,26 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
 
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
 
+from src.exceptions import LLMOverloadError
 from utils.config import ConfigManager
+from utils.rate_limit import TokenBucket
+
+# 进程内共享的LLM客户端（连接池复用），首次调用时按配置创建
+_async_client: AsyncOpenAI | None = None
+_sync_client: OpenAI | None = None
+# 进程内共享的LLM调度器，所有UseAPI调用都经过它
+_scheduler: "LLMScheduler | None" = None
+
+# 调度优先级（数字越小越优先）
+PRIORITY_MENTION = 0  # 被@/被回复时的决策与回复
+PRIORITY_CAPTION = 1  # 图片/表情包描述
+PRIORITY_BACKGROUND = 2  # 普通的决策与回复
+# 流式回复的断句标点
+SENTENCE_ENDINGS = "。！？!?…~～"
 
 
 def build_llm_vision_content(image_urls:str,text:str) ->list:
@@ -19,44 +38,319 @@ def build_llm_vision_content(image_urls:str,text:str) ->list:
         }
     ]
 
-async def UseAPI(current_uesrmsg, global_cfg: ConfigManager,model:str, llm_role: str = None, history: list = None):
+class LLMScheduler:
     """
-    :内部方法
-    :current_uesrmsg:当前用户发送的消息
-    :history: 历史消息，类型为元组列表如（[("usermsg","aimsg")]）
-    :return: str
+    :全局LLM调度器
+    :argument 限制最大并发，按RPM/TPM令牌桶限流；等待队列按优先级出队，同一优先级内各群轮流出队（公平）
+    :argument 队列积压超过max_queue时丢弃低优先级请求（抛出LLMOverloadError），并统计排队等待时间
     """
-    try:
-        # 初始化系统的角色
-        message = []
-        if llm_role:
-            message.append({'role': 'system', 'content': llm_role})
-        # 历史消息构建
-        if history:  # 修复：先判断history是否存在，再遍历
-            for user_msg, ai_msg in history:
-                if user_msg:
-                    message.append({'role': 'user', 'content': user_msg})
-                if ai_msg:
-                    message.append({'role': 'assistant', 'content': ai_msg})
-        # 添加当前用户消息
-        message.append({'role': 'user', 'content': current_uesrmsg})
-
-        # 创建连接
-        client = OpenAI(
+
+    def __init__(self, log=None, max_concurrency: int = 8, rpm: float = 0, tpm: float = 0,
+                 max_queue: int = 100, shed_priority: int = PRIORITY_BACKGROUND):
+        """
+        :param max_concurrency: 同时进行的LLM调用上限
+        :param rpm: 每分钟请求数上限，<=0不限
+        :param tpm: 每分钟token数上限（按字符数估算），<=0不限
+        :param max_queue: 等待队列上限
+        :param shed_priority: 过载时可被丢弃的最高优先级（数字不小于它的请求可被丢弃）
+        """
+        self.log = log
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket.per_minute(rpm)
+        self.token_bucket = TokenBucket.per_minute(tpm)
+        self.max_queue = max_queue
+        self.shed_priority = shed_priority
+        self.running = 0
+        # 优先级 -> (群ID -> 该群的等待队列)，OrderedDict用于群间轮转
+        self._waiting: dict[int, OrderedDict] = {}
+        self._queued = 0
+        self._retry_handle: asyncio.TimerHandle | None = None
+        self.shed_count = 0
+        self.wait_stats: dict[int, dict] = {}  # 优先级 -> {count, total, max} 排队等待时间（秒）
+
+    def metrics(self) -> dict:
+        """调度指标：运行中/排队数、丢弃数、各优先级的排队等待时间"""
+        return {
+            "running": self.running,
+            "queued": self._queued,
+            "shed": self.shed_count,
+            "wait": {
+                priority: {
+                    "count": stat["count"],
+                    "avg": stat["total"] / stat["count"] if stat["count"] else 0,
+                    "max": stat["max"],
+                }
+                for priority, stat in self.wait_stats.items()
+            },
+        }
+
+    async def acquire(self, priority: int = PRIORITY_BACKGROUND, group_id=None, tokens: int = 0):
+        """排队获取调用资格，必须与release成对使用"""
+        if self._queued >= self.max_queue and not self._shed_for(priority):
+            self.shed_count += 1
+            raise LLMOverloadError(f"LLM调度队列已满（{self._queued}），丢弃优先级{priority}的请求")
+        future = asyncio.get_running_loop().create_future()
+        enqueue_time = time.monotonic()
+        self._waiting.setdefault(priority, OrderedDict()).setdefault(group_id, deque()).append((future, tokens))
+        self._queued += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已获得资格后才被取消，归还资格
+                self.release()
+            raise
+        wait = time.monotonic() - enqueue_time
+        stat = self.wait_stats.setdefault(priority, {"count": 0, "total": 0.0, "max": 0.0})
+        stat["count"] += 1
+        stat["total"] += wait
+        stat["max"] = max(stat["max"], wait)
+        if self.log and wait > 1:
+            self.log.debug(f"LLM请求排队{wait:.2f}秒（优先级{priority}，群{group_id}）")
+
+    def release(self):
+        self.running = max(self.running - 1, 0)
+        self._dispatch()
+
+    def _shed_for(self, priority: int) -> bool:
+        """为高优先级请求腾出位置：丢弃一个排队中最低优先级的请求，成功返回True"""
+        if priority >= self.shed_priority:
+            return False
+        for level in sorted(self._waiting, reverse=True):
+            if level < self.shed_priority or level <= priority:
+                break
+            groups = self._waiting[level]
+            for group_id, queue in groups.items():
+                if queue:
+                    future, _ = queue.pop()
+                    self._queued -= 1
+                    if not queue:
+                        del groups[group_id]
+                    if not future.done():
+                        future.set_exception(LLMOverloadError(f"LLM调度队列已满，优先级{level}的请求被更高优先级挤出"))
+                    self.shed_count += 1
+                    return True
+        return False
+
+    def _pop_next(self):
+        """按优先级取下一个请求，同一优先级内各群轮流；返回(future, tokens)或None"""
+        for level in sorted(self._waiting):
+            groups = self._waiting[level]
+            while groups:
+                # 只查看队首的群，真正出队时才把该群移到末尾（见_dispatch），限流等待不会打乱轮转顺序
+                group_id, queue = next(iter(groups.items()))
+                future, tokens = queue[0]
+                if future.done():
+                    # 已取消/已被丢弃
+                    queue.popleft()
+                    self._queued -= 1
+                    if not queue:
+                        del groups[group_id]
+                    continue
+                return level, group_id, future, tokens
+        return None
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency:
+            item = self._pop_next()
+            if item is None:
+                return
+            level, group_id, future, tokens = item
+            wait = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens))
+            if wait > 0:
+                # 限流中：到时间后再尝试出队
+                if self._retry_handle is None or self._retry_handle.cancelled():
+                    self._retry_handle = asyncio.get_running_loop().call_later(wait, self._retry_dispatch)
+                return
+            queue = self._waiting[level][group_id]
+            queue.popleft()
+            self._queued -= 1
+            if queue:
+                # 已出队一个请求，该群移到末尾，实现同一优先级内各群轮流
+                self._waiting[level].move_to_end(group_id)
+            else:
+                del self._waiting[level][group_id]
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self.running += 1
+            future.set_result(None)
+
+    def _retry_dispatch(self):
+        self._retry_handle = None
+        self._dispatch()
+
+def get_scheduler(global_cfg: ConfigManager, log=None) -> LLMScheduler:
+    """
+    获取进程共享的LLM调度器，参数可在[openai]节配置
+    :param log: 调度器的日志（排队过久等），首次提供时生效
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = LLMScheduler(
+            log=log,
+            max_concurrency=global_cfg.get("openai", "max_concurrency", 8),
+            rpm=global_cfg.get("openai", "rpm", 0),
+            tpm=global_cfg.get("openai", "tpm", 0),
+            max_queue=global_cfg.get("openai", "max_queue", 100),
+            shed_priority=global_cfg.get("openai", "shed_priority", PRIORITY_BACKGROUND),
+        )
+    elif _scheduler.log is None and log is not None:
+        _scheduler.log = log
+    return _scheduler
+
+def estimate_tokens(message: list, completion_tokens: int) -> int:
+    """粗略估算一次调用的token数（中文约1字1token），仅用于TPM限流"""
+    return sum(len(str(item.get("content", ""))) for item in message) + completion_tokens
+
+def get_async_client(global_cfg: ConfigManager) -> AsyncOpenAI:
+    """获取进程共享的异步客户端，连接数上限与超时可在[openai]节配置"""
+    global _async_client
+    if _async_client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=global_cfg.get("openai", "max_connections", 20),
+                max_keepalive_connections=global_cfg.get("openai", "max_keepalive_connections", 10),
+            ),
+            timeout=httpx.Timeout(
+                global_cfg.get("openai", "timeout", 60),
+                connect=global_cfg.get("openai", "connect_timeout", 10),
+            ),
+        )
+        _async_client = AsyncOpenAI(
+            api_key=global_cfg.get("openai", "api_key"),
+            base_url=global_cfg.get("openai", "base_url"),
+            max_retries=global_cfg.get("openai", "max_retries", 2),
+            http_client=http_client,
+        )
+    return _async_client
+
+def get_sync_client(global_cfg: ConfigManager) -> OpenAI:
+    """获取进程共享的同步客户端（仅在关闭async_client时使用，调用放在线程池中执行）"""
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = OpenAI(
             api_key=global_cfg.get("openai", "api_key"),
             base_url=global_cfg.get("openai", "base_url"),
+            max_retries=global_cfg.get("openai", "max_retries", 2),
+            timeout=global_cfg.get("openai", "timeout", 60),
         )
-        # 构建回复（修复：传参为message而非current_uesrmsg）
-        response = client.chat.completions.create(
+    return _sync_client
+
+async def close_llm_client():
+    """关闭共享客户端，释放连接池（程序退出时调用）"""
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+def _sync_completion(client: OpenAI, model: str, message: list) -> str:
+    """同步客户端的流式调用，在线程池中执行以免阻塞事件循环"""
+    response = client.chat.completions.create(
+        model=model,
+        messages=message,
+        stream=True
+    )
+    message_str = ""
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            message_str += chunk.choices[0].delta.content
+    return message_str
+
+def build_llm_messages(current_uesrmsg, llm_role: str = None, history: list = None) -> list:
+    """构建chat.completions的messages列表"""
+    # 初始化系统的角色
+    message = []
+    if llm_role:
+        message.append({'role': 'system', 'content': llm_role})
+    # 历史消息构建
+    if history:  # 修复：先判断history是否存在，再遍历
+        for user_msg, ai_msg in history:
+            if user_msg:
+                message.append({'role': 'user', 'content': user_msg})
+            if ai_msg:
+                message.append({'role': 'assistant', 'content': ai_msg})
+    # 添加当前用户消息
+    message.append({'role': 'user', 'content': current_uesrmsg})
+    return message
+
+async def UseAPIStream(current_uesrmsg, global_cfg: ConfigManager, model: str, llm_role: str = None, history: list = None,
+                       priority: int = PRIORITY_BACKGROUND, group_id=None):
+    """
+    :流式版本的UseAPI，逐段产出LLM生成的文本
+    :同步客户端模式下无法逐段产出，整段生成完成后一次性产出
+    :priority/group_id: 全局调度器的优先级与公平排队的分组，过载时低优先级请求抛出LLMOverloadError
+    """
+    message = build_llm_messages(current_uesrmsg, llm_role=llm_role, history=history)
+    scheduler = get_scheduler(global_cfg)
+    await scheduler.acquire(
+        priority=priority,
+        group_id=group_id,
+        tokens=estimate_tokens(message, global_cfg.get("openai", "est_completion_tokens", 300)),
+    )
+    try:
+        if not global_cfg.get("openai", "async_client", True):
+            # 同步模式：阻塞调用交给线程池，事件循环继续处理其他群的消息
+            client = get_sync_client(global_cfg)
+            yield await asyncio.to_thread(_sync_completion, client, model, message)
+            return
+
+        # 异步模式：复用共享连接池
+        client = get_async_client(global_cfg)
+        response = await client.chat.completions.create(
             model=model,
-            messages=message,  # 关键修正
+            messages=message,
             stream=True
         )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        scheduler.release()
+
+async def iter_sentences(text_stream, min_chars: int = 8):
+    """
+    :把LLM的流式输出按句子/换行切分，每凑够一句（且不少于min_chars个字符）就产出
+    :换行总是切分，句末标点仅在长度足够时切分，避免把“嗯。”这类短句单独发送
+    """
+    buffer = ""
+    async for delta in text_stream:
+        buffer += delta
+        while buffer:
+            cut = -1
+            for idx, char in enumerate(buffer):
+                if char == "\n" or (char in SENTENCE_ENDINGS and idx + 1 >= min_chars):
+                    cut = idx + 1
+                    break
+            if cut == -1:
+                break
+            # 吞掉紧跟的同类标点，如“？！”“……”
+            while cut < len(buffer) and buffer[cut] in SENTENCE_ENDINGS:
+                cut += 1
+            sentence, buffer = buffer[:cut].strip(), buffer[cut:]
+            if sentence:
+                yield sentence
+    if buffer.strip():
+        yield buffer.strip()
+
+async def UseAPI(current_uesrmsg, global_cfg: ConfigManager,model:str, llm_role: str = None, history: list = None,
+                 priority: int = PRIORITY_BACKGROUND, group_id=None):
+    """
+    :内部方法
+    :current_uesrmsg:当前用户发送的消息
+    :history: 历史消息，类型为元组列表如（[("usermsg","aimsg")]）
+    :priority/group_id: 全局调度器的优先级与公平排队的分组
+    :return: str
+    """
+    try:
         # 拼接流式响应
         message_str = ""
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                message_str += chunk.choices[0].delta.content
+        async for delta in UseAPIStream(current_uesrmsg, global_cfg=global_cfg, model=model, llm_role=llm_role, history=history,
+                                        priority=priority, group_id=group_id):
+            message_str += delta
         return message_str
     except Exception as e:
-        raise  # 抛出异常让上层处理
\ No newline at end of file
+        raise  # 抛出异常让上层处理
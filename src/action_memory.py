@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from typing import Iterator
+
+
+class ActionMemoryStore:
+    """
+    :bot的行为记忆（定长）
+    :argument 只保存渲染好的记忆文本，最多保留max_memory条；prompt只使用最近prompt_window条
+    :argument 随追加同步更新prompt用的文本块和LLM历史列表（只渲染prompt窗口内的记忆），读取为O(1)
+    :argument 可选把被挤出的旧记忆追加写入磁盘归档（jsonl，在线程中写入，不阻塞事件循环），便于事后查看
+    """
+
+    def __init__(self, max_memory: int = 15, archive_file: str = "", prompt_window: int = 15):
+        """
+        :param max_memory: 保留的最近记忆条数
+        :param archive_file: 旧记忆归档文件路径，为空则直接丢弃
+        :param prompt_window: 预渲染进prompt的最近记忆条数
+        """
+        if not isinstance(max_memory, int) or max_memory <= 0:
+            max_memory = 15
+        if not isinstance(prompt_window, int) or prompt_window <= 0:
+            prompt_window = 15
+        self.max_memory = max_memory
+        self.prompt_window = prompt_window
+        self.archive_file = archive_file
+        self.records: deque[str] = deque(maxlen=max_memory)
+        # prompt窗口内的记忆，不超过保留条数（已不保留的记忆不能出现在prompt中）
+        self.window: deque[str] = deque(maxlen=min(prompt_window, max_memory))
+        self.text = ""  # 预渲染的记忆文本块（换行分隔）
+        self.history: list[tuple[None, str]] = []  # 预渲染的(None, 记忆)历史列表
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.records)
+
+    async def append(self, memory: str):
+        """追加一条记忆，空记忆（如发送失败的动作）不记录"""
+        if not memory:
+            return
+        evicted = self.records[0] if len(self.records) == self.max_memory else None
+        self.records.append(memory)
+        self.window.append(memory)
+        # prompt窗口条数固定，重新渲染的开销与运行时长无关
+        self.text = "\n".join(self.window)
+        self.history = [(None, record) for record in self.window]
+        if evicted is not None and self.archive_file:
+            try:
+                await asyncio.to_thread(self._archive, evicted)
+            except OSError:
+                # 归档失败不影响记忆本身
+                pass
+
+    def _archive(self, memory: str):
+        archive_dir = os.path.dirname(self.archive_file)
+        if archive_dir and not os.path.exists(archive_dir):
+            os.makedirs(archive_dir, exist_ok=True)
+        with open(self.archive_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"archive_time": time.time(), "memory": memory}, ensure_ascii=False) + "\n")
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+PDF_NAME = re.compile(r"^(\d+)\.pdf$")
+
+
+class ComicArtifactCache:
+    """
+    :JM漫画下载产物（pdf/长图）的磁盘缓存索引
+    :argument sqlite记录每个本子产物的大小、最后访问时间和命中次数；总大小超过配额时按最久未访问淘汰
+    :argument 生成pdf后删除原始图片目录；发送缓存文件前做完整性校验，损坏的文件直接删除并重新下载
+    :argument 索引建立前已存在的pdf按车号纳入索引；无法对应到车号的长图（按本子名命名）单独记录，同样受配额约束
+    :argument 正在发送的本子被钉住（pin），淘汰时跳过
+    """
+
+    def __init__(self, cfg, log, extra_dirs: Callable[[], list[str]] | None = None):
+        """
+        :param extra_dirs: 返回长图等其他产物所在目录的函数（在线程中调用），用于纳入已存在的长图
+        """
+        self.log = log
+        self.pdf_dir = cfg.get("jm", "pdf_dir", "/root/LinXiaoLu_bot/JM-pdf")
+        self.quota = cfg.get("jm", "cache_quota", 5 * 1024 ** 3)  # 产物总大小上限（字节），<=0不限
+        self.keep_images = cfg.get("jm", "keep_images", False)  # 生成pdf后是否保留原始图片
+        self.index_path = cfg.get("jm", "cache_index", os.path.join(self.pdf_dir, "artifact_index.sqlite"))
+        self.extra_dirs = extra_dirs
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._pins: dict[int, int] = {}  # 车号 -> 正在使用的次数
+
+    async def lookup(self, comic_id: int) -> str | None:
+        """获取已缓存且完整的pdf路径（同时记录命中），没有则返回None"""
+        return await asyncio.to_thread(self._lookup, comic_id)
+
+    async def register(self, comic_id: int, artifacts: dict):
+        """登记新下载的产物，删除原始图片并按配额淘汰旧产物"""
+        await asyncio.to_thread(self._register, comic_id, artifacts, set(self._pins))
+
+    def pin(self, comic_id: int):
+        """钉住本子（如发送文件期间），配额淘汰时跳过，需与unpin成对使用"""
+        self._pins[comic_id] = self._pins.get(comic_id, 0) + 1
+
+    def unpin(self, comic_id: int):
+        count = self._pins.get(comic_id, 0) - 1
+        if count > 0:
+            self._pins[comic_id] = count
+        else:
+            self._pins.pop(comic_id, None)
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    # ---------------- 以下方法在线程池中执行 ----------------
+    def _open_db(self):
+        if self._db is not None:
+            return
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        with self._db_lock:
+            if self._db is not None:
+                return
+            db = sqlite3.connect(self.index_path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts (comic_id INTEGER PRIMARY KEY, pdf TEXT, files TEXT, size INTEGER, "
+                "created REAL, accessed REAL, hits INTEGER)"
+            )
+            # 无法对应到车号的已有产物（如按本子名命名的长图）
+            db.execute("CREATE TABLE IF NOT EXISTS orphans (path TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+            db.commit()
+            self._db = db
+        self._adopt_existing()
+
+    def _adopt_existing(self):
+        """把索引建立前已存在的pdf和长图纳入索引，使其同样受配额约束"""
+        with self._db_lock:
+            known = {row[0] for row in self._db.execute("SELECT comic_id FROM artifacts")}
+            known_files = {
+                os.path.abspath(path)
+                for (files,) in self._db.execute("SELECT files FROM artifacts")
+                for path in json.loads(files)
+            }
+        if os.path.isdir(self.pdf_dir):
+            for name in os.listdir(self.pdf_dir):
+                match = PDF_NAME.match(name)
+                if match and int(match.group(1)) not in known:
+                    path = os.path.join(self.pdf_dir, name)
+                    self._upsert(int(match.group(1)), path, [path], accessed=os.path.getmtime(path), hits=0)
+        dirs = {self.pdf_dir}
+        if self.extra_dirs is not None:
+            try:
+                dirs.update(self.extra_dirs())
+            except Exception as e:
+                self.log.warning(f"获取长图目录失败，只纳入pdf目录下的长图：{e}")
+        orphans = []
+        for directory in dirs:
+            if not directory or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.abspath(os.path.join(directory, name))
+                if name.lower().endswith(".png") and path not in known_files and os.path.isfile(path):
+                    orphans.append((path, os.path.getsize(path), os.path.getmtime(path)))
+        if orphans:
+            with self._db_lock:
+                self._db.executemany("INSERT OR IGNORE INTO orphans (path, size, accessed) VALUES (?, ?, ?)", orphans)
+                self._db.commit()
+
+    def _lookup(self, comic_id: int) -> str | None:
+        self._open_db()
+        with self._db_lock:
+            row = self._db.execute("SELECT pdf, files, size FROM artifacts WHERE comic_id = ?", (comic_id,)).fetchone()
+        if row is None:
+            return None
+        pdf, files, size = row
+        if not self._check_pdf(pdf):
+            self.log.warning(f"JM{comic_id}的缓存pdf不完整，删除后重新下载")
+            self._evict(comic_id, json.loads(files))
+            return None
+        with self._db_lock:
+            self._db.execute("UPDATE artifacts SET accessed = ?, hits = hits + 1 WHERE comic_id = ?", (time.time(), comic_id))
+            self._db.commit()
+        return pdf
+
+    def _register(self, comic_id: int, artifacts: dict, pinned: set):
+        self._open_db()
+        if not self.keep_images:
+            for image_dir in artifacts.get("image_dirs", []):
+                if self._is_removable_image_dir(image_dir, artifacts.get("image_base_dir")):
+                    shutil.rmtree(image_dir, ignore_errors=True)
+                elif image_dir:
+                    self.log.debug(f"图片目录{image_dir}不在下载根目录之内，不删除")
+        files = [artifacts["pdf"]] + list(artifacts.get("extras", []))
+        self._upsert(comic_id, artifacts["pdf"], files, accessed=time.time(), hits=0)
+        with self._db_lock:
+            # 重新下载生成的同名长图已归属到该本子
+            self._db.executemany("DELETE FROM orphans WHERE path = ?", [(os.path.abspath(path),) for path in files])
+            self._db.commit()
+        self._enforce_quota(keep=pinned | {comic_id})
+
+    def _is_removable_image_dir(self, image_dir: str, base_dir: str | None) -> bool:
+        """
+        只删除严格位于图片下载根目录（dir_rule的base_dir）之内的目录，防止误删：
+        如dir_rule为Bd时图片目录就是根目录本身，删除会连同其他正在下载的本子一起删掉；也不删除包含pdf目录的目录
+        """
+        if not image_dir or not base_dir or not os.path.isdir(image_dir):
+            return False
+        image_dir = os.path.realpath(image_dir)
+        base_dir = os.path.realpath(base_dir)
+        pdf_dir = os.path.realpath(self.pdf_dir)
+        if image_dir == base_dir or os.path.commonpath([image_dir, base_dir]) != base_dir:
+            return False
+        return os.path.commonpath([image_dir, pdf_dir]) != image_dir
+
+    def _upsert(self, comic_id: int, pdf: str, files: list, accessed: float, hits: int):
+        size = sum(os.path.getsize(path) for path in files if os.path.exists(path))
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifacts (comic_id, pdf, files, size, created, accessed, hits) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (comic_id, pdf, json.dumps(files, ensure_ascii=False), size, time.time(), accessed, hits),
+            )
+            self._db.commit()
+
+    def _enforce_quota(self, keep: set):
+        """总大小超过配额时，按最久未访问淘汰（刚登记的本子和被钉住的本子除外）"""
+        if self.quota <= 0:
+            return
+        with self._db_lock:
+            total = self._db.execute(
+                "SELECT (SELECT COALESCE(SUM(size), 0) FROM artifacts) + (SELECT COALESCE(SUM(size), 0) FROM orphans)"
+            ).fetchone()[0]
+            if total <= self.quota:
+                return
+            rows = self._db.execute(
+                "SELECT accessed, comic_id, files, size FROM artifacts "
+                "UNION ALL SELECT accessed, NULL, path, size FROM orphans ORDER BY accessed ASC"
+            ).fetchall()
+        for _, comic_id, files, size in rows:
+            if total <= self.quota:
+                break
+            if comic_id is None:
+                # 长图等孤立文件，files列即文件路径
+                self._evict_orphan(files)
+                self.log.info(f"JM漫画缓存超出配额，淘汰{files}（{size}字节）")
+            elif comic_id in keep:
+                continue
+            else:
+                self._evict(comic_id, json.loads(files))
+                self.log.info(f"JM漫画缓存超出配额，淘汰JM{comic_id}（{size}字节）")
+            total -= size
+
+    def _evict(self, comic_id: int, files: list):
+        for path in files:
+            self._remove_file(path)
+        with self._db_lock:
+            self._db.execute("DELETE FROM artifacts WHERE comic_id = ?", (comic_id,))
+            self._db.commit()
+
+    def _evict_orphan(self, path: str):
+        self._remove_file(path)
+        with self._db_lock:
+            self._db.execute("DELETE FROM orphans WHERE path = ?", (path,))
+            self._db.commit()
+
+    def _remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.log.warning(f"删除缓存文件{path}失败：{e}")
+
+    @staticmethod
+    def _check_pdf(path: str) -> bool:
+        """完整性校验：文件存在、以%PDF开头且末尾有%%EOF（下载/转换中断的文件通常缺少结尾）"""
+        try:
+            size = os.path.getsize(path)
+            if size < 16:
+                return False
+            with open(path, "rb") as f:
+                if f.read(5) != b"%PDF-":
+                    return False
+                f.seek(max(size - 1024, 0))
+                return b"%%EOF" in f.read()
+        except OSError:
+            return False
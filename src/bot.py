@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import datetime
+import os
 import time
 import uuid
-import random
+from collections import OrderedDict, deque
+from contextlib import aclosing
 
-from src.JM import search_comic, download_comics
-from src.LLM_API import UseAPI,build_llm_vision_content
-from src.exceptions import MessageStreamParamError
+from src.JM import search_comic_cached
+from src.action_memory import ActionMemoryStore
+from src.caption import CaptionCache, CaptionPipeline
+from src.comic_download import ComicDownloadManager
+from src.LLM_API import UseAPI,UseAPIStream,build_llm_vision_content,iter_sentences,get_scheduler,PRIORITY_MENTION,PRIORITY_CAPTION,PRIORITY_BACKGROUND
+from src.exceptions import MessageStreamParamError, LLMOverloadError
+from src.msg_ring_buffer import MessageRingBuffer
 from src.napcat_msg import Group_Msg, choice_send_tpye
+from src.reply_gate import ReplyGate
+from utils.bounded_queue import BoundedQueue
 
 
 class MessageStreamObject:
@@ -29,22 +37,98 @@ class MessageStreamObject:
     STREAM_TYPE = [GROUP]
 
 
-    def __init__(self,group_id:int =None,stream_type:str=None):
+    def __init__(self,group_id:int =None,stream_type:str=None,capacity:int = 200):
         self.crate_time = time.time()
         self.stream_id = uuid.uuid4()
         self.stream_name: str = ""
-        self.stream_msg: dict = {}  # 这里放置受到的群聊消息
+        self.stream_msg = MessageRingBuffer(capacity=capacity)  # 这里放置受到的群聊消息（定长，超出容量淘汰最旧的消息）
         self.stream_type = stream_type
         self.stream_group_id = group_id
         self.have_new_message = False
+        self.new_message_event = asyncio.Event()  # 有新消息时置位，唤醒等待中的Session
+        self.message_arrived = asyncio.Event()  # 每收到一条用户消息置位一次，用于批处理窗口计时
+        self.message_times: deque[float] = deque(maxlen=20)  # 最近用户消息的到达时间，用于估计消息频率
+        self.mention_pending = False  # 未处理的消息中是否有@bot/提及bot的消息
+        self.unread: deque[dict] = deque(maxlen=50)  # 自上次决策以来的消息元数据，供回复门控评分
+        self.self_msg_ids: deque = deque(maxlen=capacity)  # bot自己发出的消息id，用于识别“回复bot的消息”
+        self.last_active_time = time.time()  # 最后一次收到/发出消息的时间，用于判断是否休眠
+        self.pending_captions = 0  # 尚未生成完成的图片描述数
+        self.captions_done = asyncio.Event()  # 所有图片描述完成时置位
+        self.captions_done.set()
     async def update_stream_message(self):
         pass
-    async def add_new_message(self,new_message:str,new_msg_id: int,self_add:bool=False):
+    def add_pending_caption(self):
+        self.pending_captions += 1
+        self.captions_done.clear()
+    def patch_message(self,msg_id,placeholder:str,text:str,pending:bool = True):
+        """图片描述生成完成后，把消息中的占位符替换为描述（pending=False表示该占位符未登记为待完成）"""
+        msg = self.stream_msg.get(msg_id)
+        if msg is not None:
+            self.stream_msg[msg_id] = msg.replace(placeholder, text.replace("\n", "").replace("\r", ""))
+        if not pending:
+            return
+        self.pending_captions = max(self.pending_captions - 1, 0)
+        if self.pending_captions == 0:
+            self.captions_done.set()
+    async def wait_pending_captions(self,timeout:float) -> bool:
+        """等待图片描述完成，超时返回False（决策仍可基于占位符继续）"""
+        try:
+            await asyncio.wait_for(self.captions_done.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    async def add_new_message(self,new_message:str,new_msg_id: int = None,self_add:bool=False,mentioned:bool=False,meta:dict=None):
         #去掉用户消息的换行符，防止破环prompt格式
         init_msg = new_message.replace("\n", "").replace("\r", "")
         self.stream_msg[new_msg_id] = init_msg
+        self.last_active_time = time.time()
+        if self_add and new_msg_id is not None:
+            self.self_msg_ids.append(new_msg_id)
         if not self_add:
             self.have_new_message = True
+            self.message_times.append(time.monotonic())
+            self.unread.append({**(meta or {}), "mentioned": mentioned, "time": self.message_times[-1]})
+            if mentioned:
+                self.mention_pending = True
+            self.new_message_event.set()
+            self.message_arrived.set()
+    async def wait_new_message(self):
+        """挂起直到有新消息（不轮询）"""
+        while not self.have_new_message:
+            self.new_message_event.clear()
+            await self.new_message_event.wait()
+    def adaptive_quiet_period(self,base_quiet:float,max_quiet:float) -> float:
+        """
+        按最近的消息频率估计批处理窗口的静默期：群聊越活跃，窗口越长（不超过max_quiet）
+        消息平均间隔大于max_quiet（冷清群）时直接使用base_quiet，不额外增加回复延迟
+        """
+        if len(self.message_times) < 2:
+            return base_quiet
+        avg_gap = (self.message_times[-1] - self.message_times[0]) / (len(self.message_times) - 1)
+        if avg_gap > max_quiet:
+            return base_quiet
+        return min(max(base_quiet, avg_gap * 1.5), max_quiet)
+    async def wait_quiet_period(self,quiet_period:float,max_wait:float):
+        """
+        批处理窗口：直到quiet_period秒内没有新消息、总等待达到max_wait秒或有人@bot时结束
+        :param quiet_period: 静默期（秒），<=0表示不等待
+        :param max_wait: 最长等待时间（秒）
+        """
+        if quiet_period <= 0 or self.mention_pending:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max(max_wait, quiet_period)
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self.message_arrived.clear()
+            try:
+                await asyncio.wait_for(self.message_arrived.wait(), timeout=min(quiet_period, remaining))
+            except asyncio.TimeoutError:
+                return
+            if self.mention_pending:
+                return
     async def get_new_message(self,max_msg_count:int = 15) -> str:
         if not isinstance(max_msg_count, int) or max_msg_count <= 0:
             max_msg_count = 15
@@ -52,12 +136,12 @@ class MessageStreamObject:
             return ""
         if not self.stream_msg:
             return "暂无历史群聊消息"
-        # 字典转有序列表（按插入顺序，即消息时间顺序），取最后max_msg_count条
-        # 先获取所有消息值的列表，再切片取最新的N条
-        msg_values = list(self.stream_msg.values())
-        recent_msg = msg_values[-max_msg_count:]
-        messages_ = "\n".join(recent_msg)
+        # 直接取环形缓冲区中最新的N条（内容未变化时复用上次的拼接结果）
+        messages_ = self.stream_msg.joined_recent(max_msg_count)
         self.have_new_message = False
+        self.mention_pending = False
+        self.unread.clear()
+        self.new_message_event.clear()
         return messages_
 
     async def clean_excess_messages(self, keep_count: int = 15) -> int:
@@ -70,21 +154,8 @@ class MessageStreamObject:
         if not isinstance(keep_count, int) or keep_count <= 0:
             keep_count = 20
 
-        total_msg = len(self.stream_msg)
-        # 如果当前消息数≤保留数，无需清理
-        if total_msg <= keep_count:
-            return 0
-
-        # 计算需要删除的旧消息数量
-        delete_count = total_msg - keep_count
-        # 获取字典的有序键列表
-        old_msg_ids = list(self.stream_msg.keys())[:delete_count]
-        # 遍历删除旧消息
-        for msg_id in old_msg_ids:
-            del self.stream_msg[msg_id]
-
-        # 返回清理的数量，方便日志/监控
-        return delete_count
+        # 从最旧的消息开始删除，返回清理的数量，方便日志/监控
+        return self.stream_msg.trim(keep_count)
 class ChatBotSession:
     def __init__(self,cfg,log,bot,message_stream:MessageStreamObject,send_message_queue: asyncio.Queue):
         self.log = log
@@ -93,70 +164,94 @@ class ChatBotSession:
         self.bot_id = str(uuid.uuid4())
         self.send_queue = send_message_queue
         self.message_stream = message_stream
-        self.bot_action =[] #存储bot的行为记忆对象
-        self.max_memory = self.cfg.get("setup","max_bot_memory")
+        self.max_memory = self.cfg.get("setup","max_bot_memory",15)  # 保留的行为记忆条数（prompt固定只使用最近15条）
+        archive_dir = self.cfg.get("setup","action_memory_archive_dir","")  # 为空则不归档旧记忆
+        archive_file = os.path.join(archive_dir, f"{message_stream.stream_group_id}.jsonl") if archive_dir else ""
+        self.bot_action = ActionMemoryStore(max_memory=self.max_memory, archive_file=archive_file) #存储bot的行为记忆
         self.session_task = None
         self.is_running = False
-    async def get_response(self,echo:str)-> None|dict:
+        self.current_priority = PRIORITY_BACKGROUND  # 本轮决策/回复在LLM调度器中的优先级
+    async def get_response(self,echo:str,timeout:float = 5,dispatched:asyncio.Event = None,queue_timeout:float = None)-> None|dict:
+        """
+        等待echo对应的发送结果，由Bot.response_handle直接唤醒（需先调用Bot.expect_response登记）
+        :param dispatched: 出站调度器发出该消息时置位的事件；提供时timeout从发出时开始计算，在调度器中排队的时间不计入
+        :param queue_timeout: 最长排队时间（秒），None表示一直等待
+        """
+        waiter = self.bot.response_waiters.get(echo)
+        future = waiter[1] if waiter else self.bot.expect_response(echo)
         try:
-            start_time = time.time()
-            # 超时控制（总超时时间，比如5秒）
-            while time.time() - start_time < 5:
-                async with self.bot.response_Lock:  # 加锁读取
-                    resp = self.bot.bot_response_queue.get(echo)
-                    if resp:
-                        del self.bot.bot_response_queue[echo]  # 匹配后立即删除，避免重复
-                        return resp
-                await asyncio.sleep(0.1)  # 短轮询，降低CPU消耗
-            raise TimeoutError(f"echo={echo} 响应超时")
+            if dispatched is not None and not dispatched.is_set():
+                dispatched_task = asyncio.ensure_future(dispatched.wait())
+                try:
+                    done, _ = await asyncio.wait({future, dispatched_task}, timeout=queue_timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    dispatched_task.cancel()
+                if not done:
+                    self.log.warning(f"获取响应失败：echo={echo} 在出站队列中等待超过{queue_timeout}秒")
+                    return None
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f"获取响应失败：echo={echo} 响应超时")
+            return None
         except Exception as e:
             self.log.warning(f"获取响应失败：{e}")
             return None
-    async def get_action_memory(self,max_memory:int = 15,llm_list:bool = False)->str|list:
+        finally:
+            self.bot.discard_response_waiter(echo)
+    async def get_action_memory(self,max_memory:int = None,llm_list:bool = False)->str|list:
+        """获取最近的行为记忆，默认直接返回预渲染的prompt窗口（最近15条）"""
         if not self.bot_action:
             return "暂无历史动作记忆"
-        action_memory = []
+        if max_memory is None or min(max_memory, len(self.bot_action)) == len(self.bot_action.window):
+            return self.bot_action.history if llm_list else self.bot_action.text
+        recent = list(self.bot_action)[-max_memory:]
         if not llm_list:
-            for action in self.bot_action:
-                memory:str = await action.get_until_action_memory()
-                action_memory.append(memory)
-            memories = "\n".join(action_memory[-max_memory:])
-            return memories
-        else:
-            for action in self.bot_action[-max_memory:]:
-                action_memory.append((None,await action.get_until_action_memory()))
-            return action_memory
+            return "\n".join(recent)
+        return [(None, memory) for memory in recent]
 
     def get_item_by_distance_from_latest(self,distance) -> tuple|None:
         """获取距离最新值指定距离的键值对"""
-        item_list = list(self.message_stream.stream_msg.items())  # 转换为(键, 值)的列表
-        target_index = -1 - distance
-
-        if abs(target_index) > len(item_list):
+        try:
+            distance = int(distance)  # LLM给出的执行参数为字符串
+        except (TypeError, ValueError):
             return None
-
-        return item_list[target_index]
+        return self.message_stream.stream_msg.get_by_distance(distance)
 
     async def run_session(self):
         self.is_running = True
         self.log.info(f"Session started for {self.bot_id}群id{self.message_stream.stream_id}")
         while self.is_running:
-            if not self.message_stream.stream_msg or not self.message_stream.have_new_message:
-                await asyncio.sleep(0.1)
-                continue
+            # 挂起直到add_new_message唤醒，再用批处理窗口合并连续的消息（决策期间到达的消息同样先合并）
+            await self.message_stream.wait_new_message()
+            quiet_period = self.cfg.get("setup","quiet_period",0)
+            if self.cfg.get("setup","adaptive_batch",True):
+                quiet_period = self.message_stream.adaptive_quiet_period(
+                    base_quiet=quiet_period,
+                    max_quiet=self.cfg.get("setup","batch_window_max",2),
+                )
+            await self.message_stream.wait_quiet_period(
+                quiet_period=quiet_period,
+                max_wait=self.cfg.get("setup","quiet_period_max_wait",3),
+            )
+            # 本地预筛选：@bot/回复bot必回，噪声消息跳过，其余按概率回复
+            if self.bot.reply_gate.should_reply(list(self.message_stream.unread), group_id=self.message_stream.stream_group_id):
+                # 被@/被回复时优先调度，普通插话在LLM过载时可被丢弃
+                direct = any(meta.get("mentioned") or meta.get("reply_to_self") for meta in self.message_stream.unread)
+                self.current_priority = PRIORITY_MENTION if direct else PRIORITY_BACKGROUND
+                # 可选：短暂等待尚未完成的图片描述，让决策看到图片内容
+                caption_wait = self.cfg.get("setup","caption_wait",0)
+                if caption_wait > 0 and self.message_stream.pending_captions:
+                    await self.message_stream.wait_pending_captions(timeout=caption_wait)
+                msg = await self.message_stream.get_new_message()
+                new_action = Action(cfg=self.cfg,log=self.log)
+                decision =await new_action.generate_decision(bot_session=self,chat_context=msg)
+                decision_dict=await new_action.parsing_decision(decision)
+                await new_action.execute_action(bot_session=self,chat_context=msg,decision=decision_dict)
+                await self.bot_action.append(await new_action.get_until_action_memory())
             else:
-                if random.random() < self.cfg.get("setup","probability_reply"): #概率回复
-                    msg = await self.message_stream.get_new_message()
-                    new_action = Action(cfg=self.cfg,log=self.log)
-                    decision =await new_action.generate_decision(bot_session=self,chat_context=msg)
-                    decision_dict=await new_action.parsing_decision(decision)
-                    await new_action.execute_action(bot_session=self,chat_context=msg,decision=decision_dict)
-                    self.bot_action.append(new_action)
-                else:
-                    await self.message_stream.get_new_message()
-                    self.log.debug("概率，不回复")
-                    await asyncio.sleep(0.1)
-                    continue
+                await self.message_stream.get_new_message()
+                self.log.debug("概率，不回复")
 
     async def stop_session(self):
         """停止session任务"""
@@ -194,7 +289,10 @@ class Action:
 【决策核心逻辑】（结合记忆、上下文与人设，以第一人称一句话总结你做了什么，为什么这么做，无多余文字/解释/换行）
 【主动作】（工具标识）【决策依据】（选此动作的原因）【执行参数】（具体参数，无则填“无”）
 【辅助动作】（工具标识/无）【决策依据】（原因/无）【执行参数】（参数/无）
-【辅助动作】（工具标识/无）【决策依据】（原因/无）【执行参数】（参数/无)"""
+【辅助动作】（工具标识/无）【决策依据】（原因/无）【执行参数】（参数/无){{reply_format}}"""
+    # 合并决策与回复模式下追加的输出格式：一次LLM调用同时给出动作和回复内容
+    fused_reply_format = """
+【回复内容】（主动作为REPLY时填写要发送的群聊回复：口语化、平淡、符合人设、不要长篇大论、不要动作描述；主动作不是REPLY则填“无”）"""
     def __init__(self,cfg,log):
         self.cfg = cfg
         self.log = log
@@ -215,6 +313,7 @@ class Action:
         【决策核心逻辑】决策依据
         【主动作】工具标识【决策依据】原因【执行参数】参数
         【辅助动作】工具标识【决策依据】原因【执行参数】参数（0-2个）
+        【回复内容】回复（仅合并决策与回复模式，可续行）
         :param text: 待解析文本（按行分隔，支持任意字段缺失）
         :return: 结构化字典，解析失败返回标准兜底值
         """
@@ -236,8 +335,14 @@ class Action:
             decision_logic = ""  # 决策核心逻辑内容
             main_action_content = ""  # 主动作原始内容
             aux_action_contents = []  # 辅助动作原始内容（按顺序收集，最多2个）
+            reply_lines = []  # 合并模式下的回复内容（允许换行续写）
+            mark = ""
 
             for line in lines:
+                # 回复内容可能被LLM写成多行，续行直接拼接
+                if mark == "回复内容" and not line.startswith("【"):
+                    reply_lines.append(line)
+                    continue
                 # 格式校验：行必须以【开头且包含】，否则直接判定格式错误
                 if not line.startswith("【") or "】" not in line:
                     return DEFAULT_RESULT
@@ -254,6 +359,8 @@ class Action:
                 elif mark == "辅助动作":
                     if len(aux_action_contents) < 2:
                         aux_action_contents.append(content)
+                elif mark == "回复内容":
+                    reply_lines.append(content)
 
             # 步骤3：核心字段校验 - 必须同时有【决策核心逻辑】和【主动作】，否则兜底
             if not decision_logic or not main_action_content:
@@ -299,7 +406,8 @@ class Action:
                 "decision_logic": decision_logic,
                 "main_action": main_action,
                 "aux_action1": aux_action1,
-                "aux_action2": aux_action2
+                "aux_action2": aux_action2,
+                "reply_text": "".join(reply_lines).strip() or "无"
             }
 
         # 捕获所有解析异常（分割错误、索引越界、格式异常等），统一返回标准兜底
@@ -322,16 +430,20 @@ class Action:
             tools = "\n".join(Action.tools)
 
             # 2. 填充Prompt占位符（替换{{}}为实际内容）
+            reply_format = Action.fused_reply_format if self.cfg.get("setup", "fused_reply", False) else ""
             full_prompt = Action.prompt.replace("{{action_memory}}", action_memory) \
                 .replace("{{chat_context}}", chat_context) \
-                .replace("{{tools}}", tools)
+                .replace("{{tools}}", tools) \
+                .replace("{{reply_format}}", reply_format)
             self.log.debug(f"决策Prompt构建完成：{full_prompt}")
 
             llm_response = await UseAPI(
                 current_uesrmsg=full_prompt,
                 model=self.cfg.get("openai", "model"),
                 global_cfg=self.cfg,
-                llm_role=self.cfg.get("setup", "setting")  # 复用人设，保证行为一致性
+                llm_role=self.cfg.get("setup", "setting"),  # 复用人设，保证行为一致性
+                priority=bot_session.current_priority,
+                group_id=bot_session.message_stream.stream_group_id,
             )
 
             if not llm_response:
@@ -339,6 +451,9 @@ class Action:
                 return ""
             self.log.debug(f"会话{bot_session.bot_id}获取LLM决策响应：{llm_response[:300]}...")
             return llm_response
+        except LLMOverloadError as e:
+            self.log.warning(f"会话{bot_session.bot_id}的决策请求被LLM调度器丢弃：{e}")
+            return ""
         except Exception as e:
             self.log.error(f"为会话{bot_session.bot_id}生成决策失败：{str(e)}", exc_info=True)
             return ""
@@ -364,6 +479,9 @@ class Action:
             new_group_msg = Group_Msg(
                 group_id=bot_session.message_stream.stream_group_id
             )
+            # 流式回复模式：REPLY推迟到其他动作（AT/REPLYMSG）构建完成后再逐句发送
+            stream_reply = self.cfg.get("setup", "stream_reply", False)
+            stream_reply_reason = None
 
             # 2. 按顺序执行每个动作
             for action_type, action_info in actions:
@@ -378,7 +496,12 @@ class Action:
 
                 # 3. 执行有效动作：调用对应动作方法，传递参数和群ID
                 self.log.info(f"执行{action_type}：{act} | 依据：{act_reason}... | 参数：{act_params[:50]}...")
-                if "REPLY" == act:
+                if "REPLY" == act and decision.get("reply_text", "无") != "无":
+                        # 合并模式：决策时已生成回复内容，无需再调用一次LLM
+                        await new_group_msg.build_text_msg(text=decision["reply_text"])
+                elif "REPLY" == act and stream_reply:
+                        stream_reply_reason = act_reason
+                elif "REPLY" == act:
                         # 文字回复：调用reply_action，传递执行参数和群ID
                         await self.reply_action(
                             bot_session=bot_session,
@@ -399,16 +522,18 @@ class Action:
                 else:
                         self.log.warning(f"不支持的动作类型：{act}，跳过执行")
                 continue  # 单个动作失败，不影响其他动作执行
-            try:
-                # 构造payload
-                payload = choice_send_tpye(
-                    payload=await new_group_msg.return_complete_websocket_payload(),
-                    send_type="websocket",
+            if stream_reply_reason is not None:
+                await self.stream_reply_action(
+                    bot_session=bot_session,
+                    chat_context=chat_context,
+                    inner_os=stream_reply_reason,
+                    group_msg=new_group_msg,
+                    decision=decision,
                 )
-                # 发送payload
-                await bot_session.send_queue.put(payload)
-                # 获取响应
-                response = await bot_session.get_response(echo=new_group_msg.echo)
+                self.log.info(f"会话{bot_session.bot_id}的动作决策执行完成")
+                return
+            try:
+                response = await self.send_group_msg(bot_session=bot_session,group_msg=new_group_msg)
                 if response:
                     if response["status"] == "ok":
                         self.log.debug("收到正确响应,bot正在记忆数据")
@@ -436,12 +561,30 @@ class Action:
         except Exception as e:
             self.log.error(f"执行动作决策总流程失败：{str(e)}", exc_info=True)
 
-    async def reply_action(self,bot_session:ChatBotSession,chat_context,inner_os:str,group_msg:Group_Msg):
+    async def send_group_msg(self,bot_session:ChatBotSession,group_msg:Group_Msg) -> dict|None:
         """
-
-        :return: 返回动作的完成状态
+        通过websocket发送群消息并等待发送结果，超时返回None
+        响应超时从出站调度器发出消息时开始计算（群/账号限流下的排队时间不计入），至少等到adapter的响应超时
         """
-        template_msg = f"""你注意到了这个群聊，该群聊的聊天记录如下：
+        # 构造payload
+        payload = choice_send_tpye(
+            payload=await group_msg.return_complete_websocket_payload(),
+            send_type="websocket",
+        )
+        # 由adapter在调度器发出该消息时置位，不随消息发送给napcat
+        dispatched = asyncio.Event()
+        payload["dispatched"] = dispatched
+        response_timeout = self.cfg.get("adapter", "response_timeout", 10) + 1
+        queue_timeout = self.cfg.get("bot", "send_queue_timeout", 120)  # 消息在出站队列中的最长等待（秒）
+        # 先登记等待者再发送payload，避免响应先于登记到达被丢弃
+        bot_session.bot.expect_response(group_msg.echo, ttl=queue_timeout + response_timeout)
+        await bot_session.send_queue.put(payload)
+        # 获取响应
+        return await bot_session.get_response(echo=group_msg.echo, timeout=response_timeout,
+                                              dispatched=dispatched, queue_timeout=queue_timeout)
+    @staticmethod
+    def build_reply_prompt(chat_context,inner_os:str) -> str:
+        return f"""你注意到了这个群聊，该群聊的聊天记录如下：
 {chat_context}
 你现在正在想：{inner_os}
 基于聊天记录的语境和角色身份以及心理，生成一句符合人设的**群聊回复**；
@@ -450,21 +593,87 @@ class Action:
 必须口语化，适应QQ群聊天。不要长篇大论。
 回复不要浮夸，不要用夸张修辞，平淡一些符合日常群聊的说话习惯，不要输出多余的内容比如：(动作描述)。
 仅输出要回复的内容"""
+    async def reply_action(self,bot_session:ChatBotSession,chat_context,inner_os:str,group_msg:Group_Msg):
+        """
+
+        :return: 返回动作的完成状态
+        """
+        template_msg = self.build_reply_prompt(chat_context=chat_context,inner_os=inner_os)
         try:
             # 获取ai的实际回复
             response = await UseAPI(current_uesrmsg=template_msg,
                                     model=self.cfg.get("openai", "model"),
                                     history=await bot_session.get_action_memory(llm_list=True),
                                     global_cfg=self.cfg,
-                                    llm_role=self.cfg.get("setup", "setting"))
+                                    llm_role=self.cfg.get("setup", "setting"),
+                                    priority=bot_session.current_priority,
+                                    group_id=bot_session.message_stream.stream_group_id)
 
             #存入消息
             await group_msg.build_text_msg(text=response)
         except Exception as e:
             self.log.error(f"Session {bot_session.bot_id} 处理消息失败：{e}", exc_info=True)
             self.log.error(f"{e}")
+    async def stream_reply_action(self,bot_session:ChatBotSession,chat_context,inner_os:str,group_msg:Group_Msg,decision:dict):
+        """
+        流式回复：LLM每生成完一句就立即发送，首句携带已构建的AT/回复消息段
+        每句等待发送结果后再发下一句，保证群内顺序；聊天流中只记录合并后的完整回复
+        LLM输出由单独的任务读入队列，按生成速度结束并归还调度器名额，不受发送限流和等待回执的拖累
+        """
+        template_msg = self.build_reply_prompt(chat_context=chat_context,inner_os=inner_os)
+        min_chars = self.cfg.get("setup", "stream_reply_min_chars", 8)
+        sent_msg = []  # 已成功发送的每句原文
+        first_msg_id = None
+        current_msg = group_msg
+        try:
+            text_stream = UseAPIStream(current_uesrmsg=template_msg,
+                                       model=self.cfg.get("openai", "model"),
+                                       history=await bot_session.get_action_memory(llm_list=True),
+                                       global_cfg=self.cfg,
+                                       llm_role=self.cfg.get("setup", "setting"),
+                                       priority=bot_session.current_priority,
+                                       group_id=bot_session.message_stream.stream_group_id)
+            sentence_queue: asyncio.Queue = asyncio.Queue()
+            producer = asyncio.create_task(self._read_sentences(text_stream, min_chars, sentence_queue))
+            try:
+                while (sentence := await sentence_queue.get()) is not None:
+                    await current_msg.build_text_msg(text=sentence)
+                    response = await self.send_group_msg(bot_session=bot_session,group_msg=current_msg)
+                    if not response or response.get("status") != "ok":
+                        self.log.warning(f"会话{bot_session.bot_id}流式回复发送失败，停止后续发送：{response}")
+                        break
+                    if first_msg_id is None:
+                        first_msg_id = response["data"].get("message_id")
+                    sent_msg.append(current_msg.raw_msg)
+                    current_msg = Group_Msg(group_id=bot_session.message_stream.stream_group_id)
+            finally:
+                # 提前结束时停止生成（已生成完时无影响）
+                producer.cancel()
+                error, = await asyncio.gather(producer, return_exceptions=True)
+            if isinstance(error, Exception):
+                raise error
+        except Exception as e:
+            self.log.error(f"Session {bot_session.bot_id} 流式回复失败：{e}", exc_info=True)
+        if not sent_msg:
+            self.log.warning(f"会话{bot_session.bot_id}流式回复未发送任何内容，不计入bot的记忆")
+            return
+        # 创建历史动作记忆，对话记忆（合并为一条完整回复）
+        now_time = datetime.datetime.now()
+        final_msg = f"{now_time} [小鹿]-[管理]: {''.join(sent_msg)}"
+        await bot_session.message_stream.add_new_message(new_msg_id=first_msg_id,new_message=final_msg,self_add=True)
+        await self.add_until_action_memory(decision['decision_logic'])
+    @staticmethod
+    async def _read_sentences(text_stream, min_chars: int, sentence_queue: asyncio.Queue):
+        """把LLM的流式输出按句放入队列，结束（含异常/取消）时放入None"""
+        try:
+            # 关闭两层生成器，及时归还LLM调度器的并发名额并关闭HTTP流，而不是等垃圾回收
+            async with aclosing(text_stream), aclosing(iter_sentences(text_stream, min_chars=min_chars)) as sentences:
+                async for sentence in sentences:
+                    sentence_queue.put_nowait(sentence)
+        finally:
+            sentence_queue.put_nowait(None)
     async def search_comic_action(self,bot_session:ChatBotSession,comic_keyword:str|int):
-        text = search_comic(comic_keyword=comic_keyword)
+        text = await search_comic_cached(comic_keyword=comic_keyword, global_cfg=self.cfg)
         # 创建消息，
         new_group_msg = Group_Msg(group_id=bot_session.message_stream.stream_group_id, )
         await new_group_msg.build_text_msg(text=text)
@@ -482,24 +691,72 @@ class Action:
     async def silent_action(self,):
         pass
     async def download_comic_action(self,bot_session:ChatBotSession,comic_id:int):
-        file_data = download_comics(comic_id=comic_id)
-        if file_data:
-            new_group_msg = Group_Msg(group_id=bot_session.message_stream.stream_group_id, )
-            await new_group_msg.build_file_msg(file_name=f"{comic_id}.pdf",file=file_data)
-            payload: dict = await new_group_msg.return_complete_http_payload()
-            #选择发送方式
-            send_msg =choice_send_tpye(payload=payload,send_type="http")
+        """提交后台下载任务，立即返回；下载进度和文件由下载管理器回调发送到本群"""
+        try:
+            comic_id = int(str(comic_id).strip().upper().removeprefix("JM").strip())  # LLM给出的执行参数为字符串
+        except ValueError:
+            self.log.warning(f"Session {bot_session.bot_id} 下载参数不是有效的JM号：{comic_id}")
+            return
+
+        async def notify(stage: str, info: str):
+            if stage == ComicDownloadManager.DONE:
+                await self.send_comic_file(bot_session=bot_session, comic_id=comic_id, file_data=info)
+            elif stage == ComicDownloadManager.STARTED:
+                await self.send_notice(bot_session=bot_session, text=f"JM{comic_id}开始下载了，下载完成后会发到群里")
+            else:
+                await self.send_notice(bot_session=bot_session, text=f"JM{comic_id}{info}")
+
+        status = await bot_session.bot.comic_downloads.submit(comic_id, notify)
+        self.log.info(f"Session {bot_session.bot_id} 提交JM{comic_id}下载任务：{status}")
+        if status == "joined":
+            await self.send_notice(bot_session=bot_session, text=f"JM{comic_id}已经在下载中，完成后一起发送")
+        elif status == "queued" and len(bot_session.bot.comic_downloads.jobs) > bot_session.bot.comic_downloads.workers:
+            await self.send_notice(bot_session=bot_session, text=f"JM{comic_id}已加入下载队列，前面还有其他下载任务")
+        elif status == "full":
+            await self.send_notice(bot_session=bot_session, text="下载任务太多了，请稍后再试")
+    async def send_notice(self,bot_session:ChatBotSession,text:str):
+        """发送一条文本通知到本群，并记入聊天流"""
+        new_group_msg = Group_Msg(group_id=bot_session.message_stream.stream_group_id, )
+        await new_group_msg.build_text_msg(text=text)
+        payload: dict = await new_group_msg.return_complete_websocket_payload()
+        send_msg = choice_send_tpye(payload=payload, send_type="websocket")
+        await bot_session.send_queue.put(send_msg)
+        now_str_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        alias_name = self.cfg.get("setup", "alias_name")
+        await bot_session.message_stream.add_new_message(f"{now_str_time} [{alias_name}]: {text}", self_add=True)
+    async def send_comic_file(self,bot_session:ChatBotSession,comic_id:int,file_data:str):
+        """把下载好的pdf发送到本群，发送完成（或超时）前钉住缓存中的该本子，防止被配额淘汰"""
+        new_group_msg = Group_Msg(group_id=bot_session.message_stream.stream_group_id, )
+        await new_group_msg.build_file_msg(file_name=f"{comic_id}.pdf",file=file_data)
+        payload: dict = await new_group_msg.return_complete_http_payload()
+        #选择发送方式
+        send_msg =choice_send_tpye(payload=payload,send_type="http")
+        send_timeout = self.cfg.get("jm", "send_timeout", 600)  # 等待文件发送结果的最长时间（秒）
+        artifacts = bot_session.bot.comic_downloads.artifacts
+        artifacts.pin(comic_id)
+        try:
+            bot_session.bot.expect_response(new_group_msg.echo, ttl=send_timeout)
             # 放入消息发送队列
             await bot_session.send_queue.put(send_msg)
-            # 获取自己的消息
-            now_str_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            alias_name = self.cfg.get("setup", "alias_name")
-            str_msg = f"{now_str_time} [{alias_name}]: [发送了一个{comic_id}.pdf文件]"  # 将ai的回复添加进聊天流
-            await bot_session.message_stream.add_new_message(str_msg, self_add=True)
-            self.log.info(f"Session {bot_session.bot_id} 消息：{comic_id}.pdf文件正在发送")
-        else:
-            self.log.warning("文件不存在")
+            response = await bot_session.get_response(echo=new_group_msg.echo, timeout=send_timeout)
+        finally:
+            artifacts.unpin(comic_id)
+        if not response or response.get("status") != "ok":
+            self.log.warning(f"Session {bot_session.bot_id} {comic_id}.pdf文件发送失败：{response}")
+            return
+        # 获取自己的消息
+        now_str_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        alias_name = self.cfg.get("setup", "alias_name")
+        str_msg = f"{now_str_time} [{alias_name}]: [发送了一个{comic_id}.pdf文件]"  # 将ai的回复添加进聊天流
+        await bot_session.message_stream.add_new_message(str_msg, self_add=True)
+        self.log.info(f"Session {bot_session.bot_id} 消息：{comic_id}.pdf文件已发送")
 class Bot:
+    # 图片(sub_type=0)/表情包(sub_type=1)的视觉描述要求
+    IMAGE_REQUIREMENT = {
+        0: """请你准确的以自然语言的形式，用一段话，描述这张图片的主体和画面，将图片的特征描述出来，严禁多余的输出如：提示文明使用图片的输入等等""",
+        1: """请你准确的以自然语言的形式，用一段话，描述这张表情包表达了什么，解释它有什么梗或者含义，严禁多余的输出如：提示文明使用表情包的输入等等""",
+    }
+    IMAGE_LABEL = {0: "[发送一个了图片消息]", 1: "[发送一个了表情包消息]"}
     def __init__(self, log,cfg, message_queue: asyncio.Queue, send_message_queue: asyncio.Queue,send_response_queue: asyncio.Queue):
         self.log = log
         self.cfg = cfg
@@ -508,12 +765,35 @@ class Bot:
         self.send_response_queue = send_response_queue
         self.is_running = True  # 控制消费循环
         self.clean_task = None #后台清理任务
-        self.response_Lock = asyncio.Lock()  #锁
         self.queue_timeout = 1
         self.expired_time = self.cfg.get("bot", "expired_time")
-        self.bot_response_queue = {}
+        # echo -> (过期时间, 等待响应的Future)，按登记顺序即过期顺序排列
+        self.response_waiters: OrderedDict[str, tuple[float, asyncio.Future]] = OrderedDict()
         self.bot_session: dict[MessageStreamObject, tuple[ChatBotSession,asyncio.Task]] = {} #存储chatbot对象
-        self.msg_stream:list[MessageStreamObject] = [] #存储消息流
+        self.msg_stream:dict[tuple[str,int],MessageStreamObject] = {} #存储消息流，key为(stream_type, group_id)
+        self.hibernate_task = None #后台休眠空闲群的任务
+        # 按group_id分片的消息队列：同一个群的消息始终进入同一分片（群内有序），不同分片并发处理
+        self.shard_count = max(self.cfg.get("bot", "message_shards", 8), 1)
+        self.shard_warn_depth = self.cfg.get("bot", "shard_warn_depth", 50)
+        # 分片有界：满时按策略丢弃同群最旧的非@消息（block则暂停分发，积压传导到消息队列）
+        self.message_shards: list[BoundedQueue] = [
+            BoundedQueue(
+                maxsize=self.cfg.get("bot", "shard_queue_size", 500),
+                policy=self.cfg.get("bot", "shard_queue_policy", "drop_oldest"),
+                name=f"消息分片{i}",
+                log=log,
+                protected=self.mentions_self,
+                group_of=lambda msg: msg.get("group_id"),
+            )
+            for i in range(self.shard_count)
+        ]
+        self.shard_tasks: list[asyncio.Task] = []
+        self.caption_cache = CaptionCache(cfg=cfg, log=log)  # 图片/表情包描述缓存
+        self.reply_gate = ReplyGate(cfg=cfg, log=log)  # 调用LLM决策前的本地预筛选
+        self.comic_downloads = ComicDownloadManager(cfg=cfg, log=log)  # JM漫画后台下载任务
+        get_scheduler(cfg, log=log)  # 创建全局LLM调度器并注入日志
+        # 图片描述后台流水线，避免慢速的视觉调用阻塞消息消费
+        self.caption_pipeline = CaptionPipeline(cfg=cfg, log=log, describe=lambda stream, data, sub_type: self.describe_image(data=data, sub_type=sub_type, group_id=stream.stream_group_id))
 
     async def test_Stream_msg(self):
         """完善：打印所有消息流的详细信息（按群分类）"""
@@ -522,7 +802,7 @@ class Bot:
             self.log.info("暂无消息流数据")
             return
 
-        for stream in self.msg_stream:
+        for stream in self.msg_stream.values():
             # 打印消息流基本信息
             self.log.info(
                 f"【群ID: {stream.stream_group_id}】消息流ID: {stream.stream_id} | 创建时间: {datetime.datetime.fromtimestamp(stream.crate_time).strftime('%Y-%m-%d %H:%M:%S')} | 消息数: {len(stream.stream_msg)}")
@@ -531,13 +811,14 @@ class Bot:
                 self.log.info(f"  消息{idx}: {msg}")
         self.log.info("===== 消息流打印结束 =====\n")
     async def ensure_session_active(self, stream: MessageStreamObject):
-        """确保消息流对应的Session已激活（仅创建一次）"""
+        """确保消息流对应的Session已激活（仅创建一次，已休眠/已终止的Session原地唤醒，保留其记忆）"""
         if stream in self.bot_session:
             # 检查现有Session是否正常运行
             session, task = self.bot_session[stream]
-            if task.done() and not session.is_running:
-                self.log.info(f"群{stream.stream_group_id}的Session已终止，重新启动")
-                await self.create_and_start_bot_session(stream)
+            if task is None or task.done():
+                self.log.info(f"群{stream.stream_group_id}的Session已休眠/终止，重新启动")
+                session.session_task = asyncio.create_task(session.run_session())
+                self.bot_session[stream] = (session, session.session_task)
             return
 
         # 新消息流：创建并启动Session
@@ -561,31 +842,37 @@ class Bot:
                     return
                 # 拼接纯文本消息
                 text_message = ""
+                caption_jobs = []  # 待后台生成描述的图片：(占位符, data, sub_type, 描述前缀)
+                mentioned = False  # 是否@了bot或提及了bot的名字
+                plain_text = ""  # 仅文本消息段，供回复门控判断
+                reply_msg_id = None  # 被回复的消息id
                 for message_dict in messages:
                     if message_dict.get("type") == "text":
                         data = message_dict.get("data", {})
                         text_val = data.get("text", "")
                         text_message += text_val
-                    if message_dict.get("type") == "image":
+                        plain_text += text_val
+                    elif message_dict.get("type") == "reply":
+                        reply_msg_id = message_dict.get("data", {}).get("id")
+                    elif message_dict.get("type") == "at":
+                        at_qq = str(message_dict.get("data", {}).get("qq", ""))
+                        text_message += f"@{at_qq} "
+                        if at_qq in self.bot_ids_of(msg):
+                            mentioned = True
+                    elif message_dict.get("type") == "image":
                         data = message_dict.get("data", {})
 
-                        if data.get("sub_type") == 0: #图片消息
-                            text_requirement = """请你准确的以自然语言的形式，用一段话，描述这张图片的主体和画面，将图片的特征描述出来，严禁多余的输出如：提示文明使用图片的输入等等"""
-                            image_url = data.get("url")
-                            content = build_llm_vision_content(image_urls=image_url,text=text_requirement)
-                            response = await UseAPI(current_uesrmsg=content,model=self.cfg.get("openai","model_vision"),global_cfg=self.cfg)
-                            text_message += f"[发送一个了图片消息]：{response}"
-                        elif data.get("sub_type") == 1: #表情包消息
-                            text_requirement = """请你准确的以自然语言的形式，用一段话，描述这张表情包表达了什么，解释它有什么梗或者含义，严禁多余的输出如：提示文明使用表情包的输入等等"""
-                            image_url = data.get("url")
-                            content = build_llm_vision_content(image_urls=image_url, text=text_requirement)
-                            response = await UseAPI(current_uesrmsg=content,
-                                                    model=self.cfg.get("openai", "model_vision"),global_cfg=self.cfg)
-                            text_message += f"[发送一个了表情包消息]：{response}"
+                        if data.get("sub_type") in self.IMAGE_LABEL: #图片/表情包消息，描述交给后台流水线生成
+                            placeholder = self.caption_pipeline.new_placeholder()
+                            caption_jobs.append((placeholder, data, data.get("sub_type"), self.IMAGE_LABEL[data.get("sub_type")]))
+                            text_message += placeholder
                         else:
                             self.log.warning(f"未知的消息类型{data.get('sub_type')}")
                     else:
                         self.log.debug(f"暂不支持的消息段类型：{message_dict.get('type')}")
+                alias_name = self.cfg.get("setup", "alias_name", "")
+                if alias_name and alias_name in text_message:
+                    mentioned = True
                 # 构造格式化消息
                 send_time = msg.get("time", datetime.datetime.now().timestamp())
                 nickname = msg.get("sender", {}).get("nickname", "unknown")
@@ -602,11 +889,8 @@ class Bot:
                 str_msg = f"{now_str_time} [{nickname}]-[{role}]-[{sender_id}]: {text_message}"
 
                 # 查找/创建消息流
-                target_stream = None
-                for stream in self.msg_stream:
-                    if stream.stream_type == MessageStreamObject.GROUP and stream.stream_group_id == group_id:
-                        target_stream = stream
-                        break
+                stream_key = (MessageStreamObject.GROUP, group_id)
+                target_stream = self.msg_stream.get(stream_key)
                 #指令调试
                 self.log.debug(f"text_message: {text_message}")
                 if await self.command_debug(text_message,target_stream):
@@ -615,14 +899,28 @@ class Bot:
                 if not target_stream:
                     target_stream = MessageStreamObject(
                         group_id=group_id,
-                        stream_type=MessageStreamObject.GROUP
+                        stream_type=MessageStreamObject.GROUP,
+                        capacity=self.cfg.get("bot", "stream_capacity", 200),
                     )
-                    self.msg_stream.append(target_stream)
+                    self.msg_stream[stream_key] = target_stream
                     self.log.info(f"为群{group_id}创建新消息流")
 
                 # 追加消息并标记有新消息
-                await target_stream.add_new_message(new_message=str_msg,new_msg_id=msg_id)
+                reply_to_self = reply_msg_id is not None and any(
+                    str(self_msg_id) == str(reply_msg_id) for self_msg_id in target_stream.self_msg_ids
+                )
+                await target_stream.add_new_message(
+                    new_message=str_msg,
+                    new_msg_id=msg_id,
+                    mentioned=mentioned,
+                    meta={"text": plain_text, "reply_to_self": reply_to_self},
+                )
                 self.log.debug(f"群{group_id}消息已存入流：{str_msg}")
+                # 提交图片描述任务，队列已满则不生成描述
+                for placeholder, data, sub_type, label in caption_jobs:
+                    if not self.caption_pipeline.submit(target_stream, msg_id, placeholder, data, sub_type, label):
+                        self.log.warning(f"图片描述队列已满，群{group_id}的图片不生成描述")
+                        target_stream.patch_message(msg_id=msg_id, placeholder=placeholder, text=label, pending=False)
 
                 # 为新消息流创建并启动Session（核心：激活Session）
                 await self.ensure_session_active(target_stream)
@@ -630,6 +928,36 @@ class Bot:
                 self.log.debug(f"暂不支持的消息类型：{message_type}，仅支持群聊消息")
         except Exception as e:
             self.log.error(f"消息处理失败：msg={msg} | 错误详情：{str(e)}", exc_info=True)
+    def expect_response(self, echo: str, ttl: float = None) -> asyncio.Future:
+        """
+        登记对echo响应的等待，返回会被response_handle唤醒的Future（重复登记时复用原Future并刷新过期时间）
+        :param ttl: 登记的有效期（秒），默认expired_time；文件上传等慢请求可以更长，其后登记的项会顺延到它之后再清理
+        """
+        waiter = self.response_waiters.get(echo)
+        if waiter is not None and not waiter[1].done():
+            future = waiter[1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+        self.response_waiters[echo] = (time.time() + (ttl or self.expired_time), future)
+        # 移到队尾，保持按登记顺序过期
+        self.response_waiters.move_to_end(echo)
+        return future
+    def discard_response_waiter(self, echo: str):
+        """移除echo的等待登记（已收到响应/超时/取消）"""
+        waiter = self.response_waiters.pop(echo, None)
+        if waiter and not waiter[1].done():
+            waiter[1].cancel()
+    async def describe_image(self, data: dict, sub_type: int, group_id=None) -> str:
+        """调用视觉模型描述图片/表情包，相同图片命中缓存或共享进行中的调用"""
+        text_requirement = self.IMAGE_REQUIREMENT[sub_type]
+        image_url = data.get("url")
+
+        async def describe():
+            content = build_llm_vision_content(image_urls=image_url, text=text_requirement)
+            return await UseAPI(current_uesrmsg=content, model=self.cfg.get("openai", "model_vision"), global_cfg=self.cfg,
+                                priority=PRIORITY_CAPTION, group_id=group_id)
+
+        return await self.caption_cache.get_caption(data=data, sub_type=sub_type, describe=describe)
     async def response_handle(self, response: dict):
         try:
             response_echo = response.get("request_echo")
@@ -637,9 +965,13 @@ class Bot:
                 self.log.warning("响应缺少request_echo字段，丢弃：%s", response)
                 return
             response["recv_time"] = time.time()
-            async with self.response_Lock:  # 加锁写入
-                self.bot_response_queue[response_echo] = response
-                self.log.debug(f"响应{response_echo}写入成功")
+            waiter = self.response_waiters.pop(response_echo, None)
+            if waiter is None or waiter[1].done():
+                # 无人等待的响应（如搜索/下载动作的发送结果）直接丢弃
+                self.log.debug(f"响应{response_echo}无等待者，丢弃")
+                return
+            waiter[1].set_result(response)
+            self.log.debug(f"响应{response_echo}已交付给等待者")
         except Exception as e:
             self.log.error("处理响应失败：%s", str(e), exc_info=True)
     async def command_debug(self, msg:str, stream_obj:MessageStreamObject) -> bool:
@@ -651,7 +983,7 @@ class Bot:
                 return True
             session, task = self.bot_session.get(stream_obj)
 
-            for stream in self.msg_stream:
+            for stream in self.msg_stream.values():
                 # 打印消息流基本信息
                 self.log.info(
                     f"【群ID: {stream.stream_group_id}】消息流ID: {stream.stream_id} | 创建时间: {datetime.datetime.fromtimestamp(stream.crate_time).strftime('%Y-%m-%d %H:%M:%S')} | 消息数: {len(stream.stream_msg)}")
@@ -667,8 +999,7 @@ class Bot:
             for bot_session,task in self.bot_session.values():
                 self.log.debug(f"当前机器人:{bot_session.bot_id}的内心os如下：")
                 await session.send_text_message(text=f"当前机器人:{bot_session.bot_id}的内心os如下：",group_id=stream_obj.stream_group_id)
-                for action in bot_session.bot_action:
-                    action_str = action.action_memory
+                for action_str in bot_session.bot_action:
                     await session.send_text_message(text=action_str,group_id=stream_obj.stream_group_id)
                     self.log.debug(f"{action_str}")
             return True
@@ -684,31 +1015,104 @@ class Bot:
 
         )
         session_task = asyncio.create_task(session.run_session())
+        session.session_task = session_task
         self.bot_session[message_stream] = (session,session_task)
         self.log.info(f"ChatbotSession-{session.bot_id}对象已创建并激活")
     async def clean_expired_echo(self):
+        """清理过期的等待登记：按登记顺序从队头弹出已过期的项（队头是有效期更长的登记时，其后的项顺延清理）"""
         while self.is_running:
-            async with self.response_Lock:
-                current_time = time.time()
-                #筛选合法消息
-                self.bot_response_queue ={
-                    echo : resp for echo, resp in self.bot_response_queue.items()
-                    if current_time - resp["recv_time"] < self.expired_time
-                }
+            current_time = time.time()
+            while self.response_waiters:
+                echo, (expire_at, future) = next(iter(self.response_waiters.items()))
+                if expire_at > current_time:
+                    break
+                self.response_waiters.popitem(last=False)
+                if not future.done():
+                    # 按“无响应”唤醒等待方，不能cancel（CancelledError会越过等待方的except Exception中断整个动作）
+                    future.set_result(None)
+                self.log.debug(f"等待响应{echo}已过期，移除")
             await asyncio.sleep(10) #十秒清理一次
 
+    async def hibernate_idle_sessions(self):
+        """定期休眠空闲群：停止Session任务并压缩消息流，群里再次有消息时由ensure_session_active唤醒"""
+        idle_time = self.cfg.get("bot", "hibernate_idle_time", 1800)
+        keep_count = self.cfg.get("bot", "hibernate_keep_messages", 15)
+        interval = self.cfg.get("bot", "hibernate_check_interval", 60)
+        while self.is_running:
+            await asyncio.sleep(interval)
+            current_time = time.time()
+            for stream, (session, task) in list(self.bot_session.items()):
+                if task is None or task.done():
+                    continue
+                if current_time - stream.last_active_time < idle_time or stream.have_new_message:
+                    continue
+                await session.stop_session()
+                self.bot_session[stream] = (session, None)
+                cleaned = await stream.clean_excess_messages(keep_count=keep_count)
+                self.log.info(f"群{stream.stream_group_id}空闲超过{idle_time}秒，Session已休眠，压缩消息{cleaned}条")
+    def get_shard_index(self, msg: dict) -> int:
+        """按group_id计算消息所属分片，无group_id的消息统一进入0号分片"""
+        group_id = msg.get("group_id")
+        if group_id is None:
+            return 0
+        return hash(group_id) % self.shard_count
+    @staticmethod
+    def bot_ids_of(msg: dict) -> set[str]:
+        """消息对应的所有bot账号：接收账号self_id + adapter附上的在线账号bot_self_ids（多账号同群时@任一账号都算@bot）"""
+        return {str(msg.get("self_id"))} | {str(bot_id) for bot_id in msg.get("bot_self_ids") or ()}
+    @staticmethod
+    def mentions_self(msg: dict) -> bool:
+        """消息是否@了bot（过载丢弃消息时尽量保留）"""
+        bot_ids = Bot.bot_ids_of(msg) | {"all"}
+        for segment in msg.get("message") or []:
+            if isinstance(segment, dict) and segment.get("type") == "at" and str(segment.get("data", {}).get("qq")) in bot_ids:
+                return True
+        return False
+    def get_shard_depths(self) -> list[int]:
+        """各分片当前积压的消息数"""
+        return [shard.qsize() for shard in self.message_shards]
     async def _consume_message_queue(self):
-        """独立消费消息队列（解耦响应队列）"""
+        """独立消费消息队列（解耦响应队列），按群分发到各分片队列"""
         while self.is_running:
             try:
                 msg = await asyncio.wait_for(self.message_queue.get(), timeout=self.queue_timeout)
-                await self.message_handle(msg)
+                shard_index = self.get_shard_index(msg)
+                await self.message_shards[shard_index].put(msg)
                 self.message_queue.task_done()
             except asyncio.TimeoutError:
                 continue
             except Exception as e:
                 self.log.error(f"消费消息队列失败：{str(e)}", exc_info=True)
 
+    async def _consume_message_shard(self, shard_index: int):
+        """消费单个分片：分片内串行处理，保证同一个群的消息顺序"""
+        shard = self.message_shards[shard_index]
+        while self.is_running:
+            try:
+                msg = await shard.get()
+                await self.message_handle(msg)
+                shard.task_done()
+            except Exception as e:
+                self.log.error(f"消费消息分片{shard_index}失败：{str(e)}", exc_info=True)
+
+    async def _report_metrics(self):
+        """定期报告各分片积压情况（积压过多时告警）、全局队列和LLM调度器的指标"""
+        interval = self.cfg.get("bot", "shard_report_interval", 60)
+        queues = {"message": self.message_queue, "send": self.send_message_queue, "response": self.send_response_queue}
+        while self.is_running:
+            await asyncio.sleep(interval)
+            depths = self.get_shard_depths()
+            self.log.debug(f"消息分片积压：{depths}")
+            shed = {shard.name: shard.shed for shard in self.message_shards if shard.shed}
+            if shed:
+                self.log.info(f"消息分片过载丢弃统计：{shed}")
+            queue_metrics = {name: queue.metrics() for name, queue in queues.items() if isinstance(queue, BoundedQueue)}
+            self.log.info(f"全局队列指标：{queue_metrics}")
+            self.log.info(f"LLM调度器指标：{get_scheduler(self.cfg).metrics()}")
+            for shard_index, depth in enumerate(depths):
+                if depth >= self.shard_warn_depth:
+                    self.log.warning(f"消息分片{shard_index}积压{depth}条消息")
+
     async def _consume_response_queue(self):
         """独立消费响应队列（解耦消息队列）"""
         while self.is_running:
@@ -729,9 +1133,16 @@ class Bot:
         try:
             # 启动后台清理过期消息任务（带异常捕获）
             self.clean_task = asyncio.create_task(self.clean_expired_echo())
+            # 启动图片描述worker
+            self.caption_pipeline.start()
+            # 启动空闲群休眠任务
+            self.hibernate_task = asyncio.create_task(self.hibernate_idle_sessions())
             # 修复：独立启动消息队列和响应队列的消费任务（解耦）
             consume_msg_task = asyncio.create_task(self._consume_message_queue())
             consume_resp_task = asyncio.create_task(self._consume_response_queue())
+            # 每个分片一个消费任务，外加分片积压报告任务
+            self.shard_tasks = [asyncio.create_task(self._consume_message_shard(i)) for i in range(self.shard_count)]
+            self.shard_tasks.append(asyncio.create_task(self._report_metrics()))
             # 等待所有消费任务完成（直到被取消）
             await asyncio.gather(consume_msg_task, consume_resp_task, self.clean_task)
         except asyncio.CancelledError:
@@ -763,16 +1174,32 @@ class Bot:
                     await consume_resp_task
                 except asyncio.CancelledError:
                     self.log.info("响应队列消费任务已取消")
-            # 3. 取消所有Session任务
+            if self.hibernate_task and not self.hibernate_task.done():
+                self.hibernate_task.cancel()
+                try:
+                    await self.hibernate_task
+                except asyncio.CancelledError:
+                    self.log.info("空闲群休眠任务已取消")
+            for shard_task in self.shard_tasks:
+                shard_task.cancel()
+            await asyncio.gather(*self.shard_tasks, return_exceptions=True)
+            self.shard_tasks.clear()
+            # 3. 停止图片描述worker，取消所有Session任务
+            await self.caption_pipeline.stop()
+            await self.comic_downloads.stop()
             for stream, (session, task) in self.bot_session.items():
-                if not task.done():
+                if task and not task.done():
                     task.cancel()
                     try:
                         await task
                     except asyncio.CancelledError:
                         self.log.info(f"Session-{session.bot_id}任务已取消")
             # 4. 清空队列和会话
-            self.bot_response_queue.clear()
+            for _, future in self.response_waiters.values():
+                if not future.done():
+                    future.cancel()
+            self.response_waiters.clear()
+            await self.caption_cache.close()
             self.bot_session.clear()
             self.msg_stream.clear()
             self.log.info("Bot已停止消费消息，资源释放完成")
\ No newline at end of file
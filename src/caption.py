@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import io
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable
+
+import aiohttp
+
+from utils.cache import TTLCache, InflightDedup
+
+# 可选依赖：安装了Pillow和imagehash时额外按感知哈希匹配（同一张图被压缩/转码后仍能命中）
+try:
+    import imagehash
+    from PIL import Image
+except ImportError:
+    imagehash = None
+    Image = None
+
+
+class CaptionCache:
+    """
+    :图片/表情包描述缓存
+    :argument 内存LRU+TTL为一级缓存，可选sqlite磁盘为二级缓存；并发的相同请求共享一次LLM调用
+    :key 优先按图片内容哈希（sha256/感知哈希）匹配，另以napcat的file id/url作为兜底key
+    """
+
+    def __init__(self, cfg, log):
+        self.cfg = cfg
+        self.log = log
+        self.ttl = cfg.get("caption", "cache_ttl", 7 * 24 * 3600)
+        self.memory = TTLCache(max_size=cfg.get("caption", "cache_size", 2048), ttl=self.ttl)
+        self.inflight = InflightDedup()
+        self.content_hash = cfg.get("caption", "content_hash", True)  # 是否下载图片计算内容哈希
+        self.max_image_bytes = cfg.get("caption", "max_image_bytes", 10 * 1024 * 1024)
+        self.disk_path = cfg.get("caption", "disk_cache_path", "")  # 为空则不启用磁盘缓存
+        self.disk_size = cfg.get("caption", "disk_cache_size", 100000)
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._db_writes = 0  # 每写入一定次数做一次磁盘容量清理
+        self._http: aiohttp.ClientSession | None = None
+        if self.disk_path:
+            self._open_db()
+
+    async def get_caption(self, data: dict, sub_type: int, describe: Callable[[], Awaitable[str]]) -> str:
+        """
+        :param data: napcat图片消息段的data
+        :param sub_type: 0图片/1表情包（两者提示词不同，分开缓存）
+        :param describe: 未命中缓存时真正调用视觉模型的协程工厂
+        :return: 图片描述
+        """
+        fallback_keys = self._fallback_keys(data, sub_type)
+        if not fallback_keys:
+            return await self._resolve(fallback_keys, data, sub_type, describe)
+        return await self.inflight.run(
+            fallback_keys[0], lambda: self._resolve(fallback_keys, data, sub_type, describe)
+        )
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    async def _resolve(self, fallback_keys: list, data: dict, sub_type: int, describe) -> str:
+        caption = await self._lookup(fallback_keys)
+        if caption is not None:
+            return caption
+        content_keys = await self._content_keys(data.get("url"), sub_type) if self.content_hash else []
+        caption = await self._lookup(content_keys)
+        if caption is not None:
+            # 同一张图换了file id：回填兜底key，下次无需再下载
+            await self._store(fallback_keys, caption)
+            return caption
+        if content_keys:
+            caption = await self.inflight.run(content_keys[0], describe)
+        else:
+            caption = await describe()
+        if caption:
+            await self._store(content_keys + fallback_keys, caption)
+        return caption
+
+    @staticmethod
+    def _fallback_keys(data: dict, sub_type: int) -> list:
+        keys = []
+        if data.get("file"):
+            keys.append(f"{sub_type}:file:{data['file']}")
+        if data.get("url"):
+            keys.append(f"{sub_type}:url:{data['url']}")
+        return keys
+
+    async def _content_keys(self, url: str, sub_type: int) -> list:
+        """下载图片并计算内容哈希，失败时返回空列表（退回兜底key）"""
+        if not url:
+            return []
+        try:
+            if self._http is None:
+                self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+            async with self._http.get(url) as response:
+                response.raise_for_status()
+                content = await response.content.read(self.max_image_bytes + 1)
+            if len(content) > self.max_image_bytes:
+                self.log.debug(f"图片超过{self.max_image_bytes}字节，不计算内容哈希")
+                return []
+        except Exception as e:
+            self.log.warning(f"下载图片计算哈希失败，使用file id作为缓存key：{e}")
+            return []
+        keys = [f"{sub_type}:sha256:{hashlib.sha256(content).hexdigest()}"]
+        if imagehash is not None:
+            try:
+                phash = await asyncio.to_thread(self._perceptual_hash, content)
+                keys.append(f"{sub_type}:phash:{phash}")
+            except Exception as e:
+                self.log.debug(f"计算感知哈希失败：{e}")
+        return keys
+
+    @staticmethod
+    def _perceptual_hash(content: bytes) -> str:
+        with Image.open(io.BytesIO(content)) as image:
+            return str(imagehash.phash(image))
+
+    async def _lookup(self, keys: list) -> str | None:
+        for key in keys:
+            caption = self.memory.get(key)
+            if caption is not None:
+                return caption
+        if self._db is None or not keys:
+            return None
+        caption = await asyncio.to_thread(self._db_get, keys)
+        if caption is not None:
+            # 磁盘命中后提升到内存
+            for key in keys:
+                self.memory.set(key, caption)
+        return caption
+
+    async def _store(self, keys: list, caption: str):
+        for key in keys:
+            self.memory.set(key, caption)
+        if self._db is not None and keys:
+            await asyncio.to_thread(self._db_set, keys, caption)
+
+    # ---------------- 磁盘缓存（sqlite） ----------------
+    def _open_db(self):
+        self._db = sqlite3.connect(self.disk_path, check_same_thread=False)
+        with self._db_lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS captions (key TEXT PRIMARY KEY, caption TEXT, created REAL, accessed REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_captions_accessed ON captions(accessed)")
+            self._db.commit()
+        self._db_prune()
+
+    def _db_get(self, keys: list) -> str | None:
+        now = time.time()
+        with self._db_lock:
+            for key in keys:
+                row = self._db.execute("SELECT caption, created FROM captions WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                caption, created = row
+                if self.ttl > 0 and created + self.ttl < now:
+                    self._db.execute("DELETE FROM captions WHERE key = ?", (key,))
+                    self._db.commit()
+                    continue
+                self._db.execute("UPDATE captions SET accessed = ? WHERE key = ?", (now, key))
+                self._db.commit()
+                return caption
+        return None
+
+    def _db_set(self, keys: list, caption: str):
+        now = time.time()
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO captions (key, caption, created, accessed) VALUES (?, ?, ?, ?)",
+                [(key, caption, now, now) for key in keys],
+            )
+            self._db.commit()
+        self._db_writes += 1
+        if self._db_writes % 1000 == 0:
+            self._db_prune()
+
+    def _db_prune(self):
+        """清理磁盘缓存：删除过期项，超出容量时按最久未访问淘汰"""
+        with self._db_lock:
+            if self.ttl > 0:
+                self._db.execute("DELETE FROM captions WHERE created < ?", (time.time() - self.ttl,))
+            self._db.execute(
+                "DELETE FROM captions WHERE key IN (SELECT key FROM captions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.disk_size,),
+            )
+            self._db.commit()
+
+
+class CaptionPipeline:
+    """
+    :图片描述的异步流水线
+    :argument 消息先以占位符存入消息流，由有界的worker池在后台生成描述，完成后替换消息流中的占位符
+    """
+
+    def __init__(self, cfg, log, describe: Callable[[object, dict, int], Awaitable[str]]):
+        """
+        :param describe: 生成描述的协程函数，参数为(消息所在的stream, 图片消息段data, sub_type)
+        """
+        self.log = log
+        self.describe = describe
+        self.worker_count = cfg.get("caption", "workers", 4)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=cfg.get("caption", "queue_size", 100))
+        self.workers: list[asyncio.Task] = []
+        self._placeholder_seq = 0
+        self.rejected = 0  # 队列已满被拒绝的描述任务数
+
+    def new_placeholder(self) -> str:
+        self._placeholder_seq += 1
+        return f"[图片描述生成中#{self._placeholder_seq}]"
+
+    def submit(self, stream, msg_id, placeholder: str, data: dict, sub_type: int, label: str) -> bool:
+        """
+        :提交描述任务，队列已满时返回False（调用方应自行替换占位符）
+        :param stream: 消息所在的MessageStreamObject
+        :param label: 描述前缀，如“[发送一个了图片消息]”
+        """
+        try:
+            self.queue.put_nowait((stream, msg_id, placeholder, data, sub_type, label))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            if self.rejected == 1 or self.rejected % 100 == 0:
+                self.log.warning(f"图片描述队列已满，拒绝新的描述任务，累计{self.rejected}次")
+            return False
+        stream.add_pending_caption()
+        return True
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    async def _worker(self):
+        while True:
+            stream, msg_id, placeholder, data, sub_type, label = await self.queue.get()
+            text = label
+            try:
+                caption = await self.describe(stream, data, sub_type)
+                text = f"{label}：{caption}"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.error(f"生成图片描述失败：{e}", exc_info=True)
+            finally:
+                stream.patch_message(msg_id=msg_id, placeholder=placeholder, text=text)
+                self.queue.task_done()
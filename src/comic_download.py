@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+from src.artifact_cache import ComicArtifactCache
+from src.JM import download_comic_artifacts, get_long_img_dirs
+
+# 下载进度通知：参数为(阶段, 附加信息)，阶段为started/done/failed，done时附加信息为file://路径，failed时为失败原因
+DownloadNotify = Callable[[str, str], Awaitable[None]]
+
+
+class ComicDownloadManager:
+    """
+    :JM漫画后台下载任务管理
+    :argument 下载在有界线程池中执行，不阻塞事件循环；同一车号的并发请求合并为一个任务，缓存中已有完整的pdf直接复用
+    :argument 每个任务有超时（从开始下载计时，不含排队时间），可取消；各阶段通过回调通知所有请求该车号的群
+    :argument 下载线程无法中断：超时/取消已开始的任务时只通知并清空当前的请求方，任务保留到线程真正结束，
+    :         期间相同车号的请求合并进来等待最终结果，不会重复下载
+    """
+
+    STARTED = "started"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, cfg, log):
+        self.log = log
+        self.workers = max(cfg.get("jm", "download_workers", 2), 1)
+        self.timeout = cfg.get("jm", "download_timeout", 900)  # 单个任务的下载超时（秒，从开始下载计时）
+        self.max_jobs = cfg.get("jm", "max_download_jobs", 10)  # 同时存在（排队+下载中）的任务上限
+        self.option_file = cfg.get("jm", "option_file", "myoption.yml")
+        self.pdf_dir = cfg.get("jm", "pdf_dir", "/root/LinXiaoLu_bot/JM-pdf")
+        # 下载产物的磁盘配额缓存（长图目录来自下载配置中的long_img插件）
+        self.artifacts = ComicArtifactCache(cfg=cfg, log=log, extra_dirs=lambda: get_long_img_dirs(self.option_file))
+        self._executor: ThreadPoolExecutor | None = None
+        self.jobs: dict[int, asyncio.Task] = {}  # 车号 -> 下载任务
+        self.listeners: dict[int, list[DownloadNotify]] = {}  # 车号 -> 等待结果的回调
+        self.started: set[int] = set()  # 下载线程已开始的车号
+        self._notify_tasks: set[asyncio.Task] = set()  # 进行中的结果通知任务（保存引用防止被回收）
+
+    async def submit(self, comic_id: int, notify: DownloadNotify) -> str:
+        """
+        :提交下载请求
+        :return: cached已有pdf（立即通知done）/joined合并到进行中的任务/queued新建任务/full任务过多被拒绝
+        """
+        if comic_id in self.jobs:
+            self.listeners[comic_id].append(notify)
+            return "joined"
+        pdf_path = await self.artifacts.lookup(comic_id)
+        if comic_id in self.jobs:
+            # 查询缓存期间已有相同车号的任务
+            self.listeners[comic_id].append(notify)
+            return "joined"
+        if pdf_path:
+            self._spawn_notify([notify], self.DONE, f"file://{pdf_path}")
+            return "cached"
+        if len(self.jobs) >= self.max_jobs:
+            return "full"
+        self.listeners[comic_id] = [notify]
+        self.jobs[comic_id] = asyncio.create_task(self._run_job(comic_id))
+        return "queued"
+
+    def cancel(self, comic_id: int) -> bool:
+        """
+        :取消下载任务
+        :argument 尚在排队的任务直接取消；已开始的下载无法中断，只通知并清空当前的请求方，任务保留到线程结束（产物仍会入缓存）
+        """
+        task = self.jobs.get(comic_id)
+        if task is None or task.done():
+            return False
+        self._spawn_notify(self._take_listeners(comic_id), self.FAILED, "下载已取消")
+        if comic_id in self.started:
+            self.log.info(f"JM{comic_id}已在下载，取消当前的请求方，下载线程结束后再释放任务")
+        else:
+            task.cancel()
+        return True
+
+    async def stop(self):
+        tasks = list(self.jobs.values()) + list(self._notify_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self.artifacts.close()
+
+    async def _run_job(self, comic_id: int):
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="jm-download")
+        started = asyncio.Event()
+
+        def download():
+            loop.call_soon_threadsafe(started.set)
+            return download_comic_artifacts(comic_id, option_file=self.option_file, pdf_dir=self.pdf_dir)
+
+        future = loop.run_in_executor(self._executor, download)
+        try:
+            # 排队阶段：等待线程开始（或在开始前就结束，如线程池已关闭）
+            started_task = asyncio.create_task(started.wait())
+            try:
+                await asyncio.wait({started_task, future}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started_task.cancel()
+            if started.is_set():
+                self.started.add(comic_id)
+                self.log.info(f"JM{comic_id}开始下载")
+                await self._notify(list(self.listeners.get(comic_id, [])), self.STARTED, "")
+            try:
+                artifacts = await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.log.warning(f"JM{comic_id}下载超时（{self.timeout}秒），等待下载线程结束后再释放任务")
+                self._spawn_notify(self._take_listeners(comic_id), self.FAILED, "下载超时")
+                # 线程无法中断，保留任务直到线程结束：期间的新请求合并进来，产物照常入缓存
+                artifacts = await future
+            if artifacts:
+                await self.artifacts.register(comic_id, artifacts)
+                self.log.info(f"JM{comic_id}下载完成：{artifacts['pdf']}")
+                # 先结束任务再通知：发送文件要等上传结果，期间的新请求走缓存命中，不会合并进已通知完的任务
+                self._spawn_notify(self._finish(comic_id), self.DONE, f"file://{artifacts['pdf']}")
+            else:
+                self.log.warning(f"JM{comic_id}下载失败")
+                self._spawn_notify(self._finish(comic_id), self.FAILED, "下载失败，可能车号不存在")
+        except asyncio.CancelledError:
+            # 排队中被取消或关闭时：线程池中尚未开始的下载随之取消
+            self.log.info(f"JM{comic_id}下载任务已取消")
+            future.cancel()
+            raise
+        except Exception as e:
+            self.log.error(f"JM{comic_id}下载异常：{e}", exc_info=True)
+            self._spawn_notify(self._finish(comic_id), self.FAILED, "下载异常")
+        finally:
+            self._finish(comic_id)
+
+    def _finish(self, comic_id: int) -> list[DownloadNotify]:
+        """结束任务的登记，返回仍在等待结果的回调"""
+        self.jobs.pop(comic_id, None)
+        self.started.discard(comic_id)
+        return self.listeners.pop(comic_id, [])
+
+    def _take_listeners(self, comic_id: int) -> list[DownloadNotify]:
+        """取出并清空当前等待该车号的回调（任务仍在时，之后的请求会重新登记）"""
+        listeners = self.listeners.get(comic_id, [])
+        if comic_id in self.listeners:
+            self.listeners[comic_id] = []
+        return listeners
+
+    def _spawn_notify(self, listeners: list[DownloadNotify], stage: str, info: str):
+        """每个请求方单独一个通知任务，各群的文件发送互不等待"""
+        for notify in listeners:
+            task = asyncio.create_task(self._notify([notify], stage, info))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    async def _notify(self, listeners: list[DownloadNotify], stage: str, info: str):
+        for notify in listeners:
+            try:
+                await notify(stage, info)
+            except Exception as e:
+                self.log.error(f"下载进度通知失败：{e}", exc_info=True)
@@ -39,4 +39,13 @@ class MessageStreamDuplicateIdError(MessageStreamBaseError):
 class MessageStreamDeleteError(MessageStreamBaseError):
     """消息删除失败（如清理消息时出现未知错误）"""
     def __init__(self, msg: str):
-        super().__init__(msg, error_code=1004)
\ No newline at end of file
+        super().__init__(msg, error_code=1004)
+class LLMBaseError(BaseAppError):
+    """LLM调用模块通用异常基类"""
+    def __init__(self, msg: str, error_code: int = 2000):
+        super().__init__(msg, error_code)
+
+class LLMOverloadError(LLMBaseError):
+    """LLM调度队列过载，低优先级请求被丢弃"""
+    def __init__(self, msg: str = "LLM调度队列已满，请求被丢弃"):
+        super().__init__(msg, error_code=2001)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from typing import Any, Iterator
+
+
+class MessageRingBuffer:
+    """
+    :固定容量的消息环形缓冲区（按插入顺序保存 消息id -> 消息文本）
+    :argument 超出容量时自动淘汰最旧的消息；按消息id查找、按“距最新消息的偏移量”查找均为O(1)
+    :兼容原先stream_msg字典的常用用法：len()、in、[]、get()、遍历键、keys/values/items
+    """
+
+    def __init__(self, capacity: int = 200):
+        if not isinstance(capacity, int) or capacity <= 0:
+            capacity = 200
+        self.capacity = capacity
+        self._slots: list[tuple[Any, str] | None] = [None] * capacity
+        self._start = 0  # 最旧消息的序号
+        self._end = 0  # 下一条消息的序号
+        self._index: dict[Any, int] = {}  # 消息id -> 序号
+        self._version = 0  # 原地修改/裁剪/清空时加1（单纯追加不变），用于判断拼接视图能否增量更新
+        # 拼接视图：(条数, 分隔符, 版本, 截至的序号, 拼接结果, 窗口内各条消息的长度)
+        self._view_cache: tuple[int, str, int, int, str, deque] | None = None
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def __contains__(self, msg_id) -> bool:
+        return msg_id in self._index
+
+    def __iter__(self) -> Iterator:
+        return self.keys()
+
+    def __getitem__(self, msg_id) -> str:
+        return self._slots[self._index[msg_id] % self.capacity][1]
+
+    def __setitem__(self, msg_id, text: str):
+        """已存在的消息原地更新（如替换图片描述占位符），否则追加为最新消息"""
+        if msg_id is None:
+            # 没有napcat消息id的消息（如bot自己发出但未取得id的消息），生成本地id
+            msg_id = f"local-{self._end}"
+        seq = self._index.get(msg_id)
+        if seq is not None:
+            self._slots[seq % self.capacity] = (msg_id, text)
+            self._version += 1
+        else:
+            if len(self) >= self.capacity:
+                self._pop_oldest()
+            self._slots[self._end % self.capacity] = (msg_id, text)
+            self._index[msg_id] = self._end
+            self._end += 1
+
+    def get(self, msg_id, default=None) -> str | None:
+        seq = self._index.get(msg_id)
+        if seq is None:
+            return default
+        return self._slots[seq % self.capacity][1]
+
+    def keys(self) -> Iterator:
+        for seq in range(self._start, self._end):
+            yield self._slots[seq % self.capacity][0]
+
+    def values(self) -> Iterator[str]:
+        for seq in range(self._start, self._end):
+            yield self._slots[seq % self.capacity][1]
+
+    def items(self) -> Iterator[tuple[Any, str]]:
+        for seq in range(self._start, self._end):
+            yield self._slots[seq % self.capacity]
+
+    def get_by_distance(self, distance: int) -> tuple[Any, str] | None:
+        """获取距最新消息distance条的(消息id, 消息)，0为最新一条，超出范围返回None"""
+        if distance < 0 or distance >= len(self):
+            return None
+        return self._slots[(self._end - 1 - distance) % self.capacity]
+
+    def recent(self, count: int) -> list[str]:
+        """按时间顺序返回最新的count条消息"""
+        count = min(count, len(self))
+        return [self._slots[seq % self.capacity][1] for seq in range(self._end - count, self._end)]
+
+    def joined_recent(self, count: int, sep: str = "\n") -> str:
+        """
+        :最新count条消息的拼接结果
+        :argument 自上次调用以来只有新消息追加时增量更新：切掉滑出窗口的旧消息、接上新消息，不重新拼接整个窗口
+        :argument 有原地修改/裁剪/清空、或count/sep变化时才重新拼接
+        """
+        window = min(count, len(self))
+        cache = self._view_cache
+        if cache is not None and cache[0] == count and cache[1] == sep and cache[2] == self._version:
+            _, _, _, cached_end, joined, lengths = cache
+            new_count = self._end - cached_end
+            if new_count == 0:
+                return joined
+            if new_count < window:
+                new_texts = [self._slots[seq % self.capacity][1] for seq in range(cached_end, self._end)]
+                drop = len(lengths) + new_count - window
+                cut = 0
+                for _ in range(drop):
+                    cut += lengths.popleft() + len(sep)
+                tail = sep.join(new_texts)
+                joined = joined[cut:] + sep + tail if lengths else tail
+                lengths.extend(len(text) for text in new_texts)
+                self._view_cache = (count, sep, self._version, self._end, joined, lengths)
+                return joined
+        texts = self.recent(window)
+        joined = sep.join(texts)
+        self._view_cache = (count, sep, self._version, self._end, joined, deque(len(text) for text in texts))
+        return joined
+
+    def trim(self, keep_count: int) -> int:
+        """只保留最新的keep_count条消息，返回删除的条数"""
+        delete_count = max(len(self) - keep_count, 0)
+        for _ in range(delete_count):
+            self._pop_oldest()
+        if delete_count:
+            self._version += 1
+        return delete_count
+
+    def clear(self):
+        self._slots = [None] * self.capacity
+        self._start = self._end = 0
+        self._index.clear()
+        self._version += 1
+
+    def _pop_oldest(self):
+        slot = self._start % self.capacity
+        msg_id, _ = self._slots[slot]
+        self._slots[slot] = None
+        self._index.pop(msg_id, None)
+        self._start += 1
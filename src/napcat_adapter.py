@@ -1,12 +1,39 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import json
+import logging
 import uuid
 from typing import Any
 
 import aiohttp
 import websockets as Server
 
+from src.outbound import OutboundScheduler, action_params
+from utils import json_codec
+
+# 元事件（心跳/生命周期）的特征串：napcat上报的JSON没有多余空格，字符串内容中的引号会被转义，不会误匹配
+META_EVENT_MARKERS = ('"post_type":"meta_event"', '"post_type": "meta_event"')
+
+# 幂等（重复执行不会产生副作用）的napcat action，HTTP请求失败时可以安全重试
+IDEMPOTENT_ACTIONS = [
+    "get_login_info",
+    "get_status",
+    "get_version_info",
+    "get_msg",
+    "get_forward_msg",
+    "get_group_info",
+    "get_group_list",
+    "get_group_member_info",
+    "get_group_member_list",
+    "get_stranger_info",
+    "get_friend_list",
+    "get_file",
+    "get_image",
+    "get_record",
+    "get_group_file_url",
+    "get_group_root_files",
+]
+
 
 class Adapter:
     def __init__(self, cfg, log, global_message_queue, global_send_queue, global_response_queue):
@@ -18,71 +45,254 @@ class Adapter:
         self.http_server_port = cfg.get("adapter", "server_port")
 
         self.active_connections = set()
+        # 多账号：按self_id记录连接，每个群分配一个负责收发的账号
+        self.connections: dict[int, Server.ServerConnection] = {}  # self_id -> 连接
+        self.connection_ids: dict[Server.ServerConnection, int] = {}  # 连接 -> self_id
+        self.group_accounts: dict[int, list[int]] = {}  # 群 -> 在该群中的账号（按首次出现顺序）
+        self.group_owner: dict[int, int] = {}  # 群 -> 负责该群的账号
+        self.http_servers: dict = cfg.get("adapter", "http_servers", {})  # 各账号的HTTP地址 {"self_id": "ip:port"}，未配置的使用server_ip/server_port
+        self._route_seq = 0  # 无法确定账号时轮流选择连接
+        # 入站帧解析：可切换JSON编解码器（默认安装了orjson时使用orjson），心跳/生命周期帧不做完整解析
+        json_codec.use_codec(cfg.get("adapter", "json_codec", json_codec.codec_name))
+        self.frame_counts = {"heartbeat": 0, "lifecycle": 0, "decoded": 0, "invalid": 0}
         self.message_queue = global_message_queue  # 接受napcat消息并向bot转发消息的队列
         self.send_msg_queue = global_send_queue  # 从bot接收待发送消息的队列
         self.send_response_queue = global_response_queue  # 向bot回传发送结果的队列
         self.server = None
-        self.response_queue = []  # 临时存储napcat的响应，用于匹配request_id
+        self.pending_responses: dict[str, asyncio.Future] = {}  # echo -> 等待napcat响应的Future
+        self.unmatched_echo_count = 0  # 无人等待（迟到/孤立）的响应计数
+        self.response_timeout = cfg.get("adapter", "response_timeout", 10)  # 单个请求的响应超时（秒）
+        # 共享的HTTP会话（keep-alive连接池），启动时创建、关闭时释放
+        self.http_session: aiohttp.ClientSession | None = None
+        self.http_connector_limit = cfg.get("adapter", "http_connector_limit", 20)
+        self.http_timeout = cfg.get("adapter", "http_timeout", 60)  # 默认的单个请求超时（秒）
+        self.http_action_timeouts: dict = cfg.get("adapter", "http_action_timeouts", {"upload_group_file": 600})  # 按action覆盖超时
+        self.http_retries = cfg.get("adapter", "http_retries", 2)  # 幂等action的最大重试次数
+        self.http_retry_backoff = cfg.get("adapter", "http_retry_backoff", 0.5)  # 重试退避基数（秒），按指数增长
+        self.http_retry_actions = set(cfg.get("adapter", "http_retry_actions", IDEMPOTENT_ACTIONS))
+        # 流水线发送：最多send_window条消息同时等待napcat响应，由出站调度器决定发送顺序和频率
+        self.send_window = max(cfg.get("adapter", "send_window", 16), 1)
+        self.send_max_pending = max(cfg.get("adapter", "send_max_pending", self.send_window * 8), self.send_window)
+        self._send_slots = asyncio.Semaphore(self.send_window)  # 在途（已发出、等待响应）的名额
+        self._pending_slots = asyncio.Semaphore(self.send_max_pending)  # 已出队未完成的名额，满时暂停出队
+        self.outbound = OutboundScheduler(cfg=cfg, log=log, account_of=self._account_of_key)  # 按群/账号限流、群内有序、文本优先于文件
+        self._send_tasks: set[asyncio.Task] = set()
+
+    async def open_http_session(self) -> aiohttp.ClientSession:
+        """创建（或返回已有的）共享HTTP会话"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(limit=self.http_connector_limit, keepalive_timeout=30)
+            self.http_session = aiohttp.ClientSession(connector=connector)
+        return self.http_session
+
+    async def close_http_session(self):
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
 
     async def put_response(self, response: dict):
-        """添加napcat的响应到临时队列，供get_response匹配"""
-        self.response_queue.append(response)
-
-    async def get_response(self, request_id: str) -> Any |None:
-        """根据request_id从响应队列中获取匹配的响应，超时返回None"""
-        retry_count = 0
-        max_retries = 50  # 每次sleep 0.2秒，总计10秒超时
-        # 移除无效的None判断，直接循环匹配
-        while retry_count < max_retries:
-            # 遍历响应队列，找到匹配的响应
-            for idx, response in enumerate(self.response_queue):
-                if response.get("echo") == request_id:
-                    # 移除并返回匹配的响应（修正pop(0)的错误）
-                    matched_response = self.response_queue.pop(idx)
-                    return matched_response
-            # 未找到则等待并重试
-            retry_count += 1
-            await asyncio.sleep(0.2)
-
-        # 超时未找到
-        raise TimeoutError(f"请求超时，未找到响应（request_id: {request_id}）")
+        """将napcat的响应交给等待该echo的Future，无人等待的响应直接丢弃并计数"""
+        echo = response.get("echo")
+        future = self.pending_responses.pop(echo, None) if echo else None
+        if future is None or future.done():
+            # 迟到（已超时）或孤立的响应
+            self.unmatched_echo_count += 1
+            self.log.debug(f"收到无人等待的响应（echo: {echo}），累计未匹配数：{self.unmatched_echo_count}")
+            return
+        future.set_result(response)
+
+    def register_response(self, request_id: str) -> asyncio.Future:
+        """发送前登记request_id，返回用于等待响应的Future（必须在发送前登记，避免响应先于登记到达）"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending_responses[request_id] = future
+        return future
+
+    async def get_response(self, request_id: str, timeout: float = None) -> Any | None:
+        """等待request_id对应的响应，超时抛出TimeoutError并清理登记项"""
+        timeout = timeout or self.response_timeout
+        future = self.pending_responses.get(request_id)
+        if future is None:
+            future = self.register_response(request_id)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"请求超时，未找到响应（request_id: {request_id}）")
+        finally:
+            # 超时/取消时移除登记项，之后到达的响应按未匹配处理
+            if self.pending_responses.get(request_id) is future:
+                del self.pending_responses[request_id]
+
+    def register_connection(self, server_connection: Server.ServerConnection, self_id):
+        """记录连接所属的账号（来自连接请求头X-Self-ID或事件中的self_id）"""
+        try:
+            self_id = int(self_id)
+        except (TypeError, ValueError):
+            return
+        if self.connection_ids.get(server_connection) == self_id:
+            return
+        self.connection_ids[server_connection] = self_id
+        self.connections[self_id] = server_connection
+        self.log.info(f"账号{self_id}已连接，当前在线账号：{list(self.connections)}")
+
+    def unregister_connection(self, server_connection: Server.ServerConnection):
+        self_id = self.connection_ids.pop(server_connection, None)
+        if self_id is None or self.connections.get(self_id) is not server_connection:
+            return
+        del self.connections[self_id]
+        # 该账号负责的群改由同群的其他在线账号接管
+        for group_id in [group_id for group_id, owner in self.group_owner.items() if owner == self_id]:
+            del self.group_owner[group_id]
+            self.assign_group_owner(group_id)
+        self.log.info(f"账号{self_id}已断开，当前在线账号：{list(self.connections)}")
+
+    def assign_group_owner(self, group_id: int, self_id: int = None) -> int | None:
+        """
+        :记录self_id在群中，并返回负责该群的账号
+        :argument 负责账号离线时，从同群的在线账号中选负责群数最少的接管，使收发负载分散到各账号
+        """
+        accounts = self.group_accounts.setdefault(group_id, [])
+        new_account = self_id is not None and self_id not in accounts
+        if new_account:
+            accounts.append(self_id)
+        owner = self.group_owner.get(group_id)
+        if owner in self.connections and not new_account:
+            return owner
+        online = [account for account in accounts if account in self.connections]
+        if not online:
+            return None
+        load = {account: 0 for account in online}
+        for account in self.group_owner.values():
+            if account in load:
+                load[account] += 1
+        candidate = min(online, key=lambda account: load[account])
+        # 新账号加入时，只有负载明显更低才接管，避免负责账号来回切换
+        if owner in self.connections and load[candidate] + 1 >= load[owner]:
+            return owner
+        self.group_owner[group_id] = candidate
+        return candidate
+
+    def _account_of_key(self, key):
+        """出站调度器的分组 -> 负责发送的账号（用于按账号限流）"""
+        if key[0] == "group":
+            return self.group_owner.get(key[1])
+        return None
+
+    def route_connection(self, payload: dict) -> Server.ServerConnection:
+        """选择发送payload的连接：指定的self_id > 负责该群的账号 > 轮流选择"""
+        self_id = payload.get("self_id")
+        if self_id is None:
+            group_id = action_params(payload).get("group_id")
+            if group_id is not None:
+                self_id = self.assign_group_owner(int(group_id))
+        if self_id is not None and int(self_id) in self.connections:
+            return self.connections[int(self_id)]
+        if not self.active_connections:
+            raise RuntimeError("无可用的websocket活跃连接")
+        connections = list(self.active_connections)
+        self._route_seq += 1
+        return connections[self._route_seq % len(connections)]
+
+    def route_http_server(self, payload: dict) -> str:
+        """选择发送payload的HTTP地址（按账号配置，未配置时使用默认地址）"""
+        self_id = payload.get("self_id")
+        if self_id is None:
+            group_id = action_params(payload).get("group_id")
+            if group_id is not None:
+                self_id = self.assign_group_owner(int(group_id))
+        server = self.http_servers.get(str(self_id)) if self_id is not None else None
+        return server or f"{self.http_server_ip}:{self.http_server_port}"
 
     async def get_send_msg_to_napcat(self):
-        """循环从Bot中取出消息交给其他方法处理"""
+        """循环从Bot中取出消息交给出站调度器，另由分派任务按调度结果并发发送"""
+        dispatch_task = asyncio.create_task(self._dispatch_sends())
+        report_task = asyncio.create_task(self._report_metrics())
+        try:
+            while True:
+                try:
+                    init_payload: dict = await asyncio.wait_for(
+                        self.send_msg_queue.get(), timeout=1.0
+                    )
+                    self.send_msg_queue.task_done()
+                    # 已出队未完成的消息过多时暂停出队，形成背压
+                    await self._pending_slots.acquire()
+                    try:
+                        self.outbound.put(init_payload)
+                    except Exception as e:
+                        # payload无法入队（如group_id不是数字）：归还名额，并向bot回传错误，避免等待方一直等到超时
+                        self._pending_slots.release()
+                        self.log.error(f"出站消息无法调度，丢弃：{e}")
+                        payload = init_payload.get("payload", {}) if isinstance(init_payload, dict) else {}
+                        await self.send_response_queue.put(
+                            {"status": "error", "message": f"无效的出站消息: {e}", "request_echo": payload.get("echo", "")}
+                        )
+                except asyncio.TimeoutError:
+                    continue  # 超时继续，检测是否需要退出
+                except asyncio.CancelledError:
+                    self.log.info("发送消息循环收到取消信号，退出")
+                    break
+                except Exception as e:
+                    self.log.error(f"处理发送队列消息错误: {e}")
+        finally:
+            dispatch_task.cancel()
+            report_task.cancel()
+            for task in list(self._send_tasks):
+                task.cancel()
+
+    async def _report_metrics(self):
+        """定期报告出站调度指标：各通道积压、在途数和排队等待时间"""
+        interval = self.cfg.get("adapter", "metrics_report_interval", 60)
+        while True:
+            await asyncio.sleep(interval)
+            self.log.info(f"出站调度指标：{self.outbound.metrics()}，发送中{len(self._send_tasks)}条")
+
+    async def _dispatch_sends(self):
+        """按出站调度器给出的顺序发送，最多send_window条同时在途"""
         while True:
+            await self._send_slots.acquire()
             try:
-                # 区分使用哪种发送方式处理payload
-                init_payload: dict = await asyncio.wait_for(
-                    self.send_msg_queue.get(), timeout=1.0
-                )
-                self.send_msg_queue.task_done()
-                send_result = None  # 存储发送结果，最终回传给bot
-                if init_payload["send_type"] == "websocket":
-                    payload = init_payload["payload"]
-                    send_result = await self.websocket_send(payload)
-                elif init_payload["send_type"] == "http":
-                    payload = init_payload["payload"]
-                    send_result = await self.http_send(payload)
-                else:
-                    self.log.warning(f"未知的send_type类型：{init_payload['send_type']}")
-                    send_result = {"status": "error", "message": f"未知的send_type: {init_payload['send_type']}"}
-
-                # 将发送结果回传给bot（核心补充：确保bot能收到响应）
-                if send_result is not None:
-                    # 补充关联原消息的标识（方便bot匹配）
-                    send_result["request_echo"] = payload.get("echo", "")
-                    await self.send_response_queue.put(send_result)
-
-            except asyncio.TimeoutError:
-                continue  # 超时继续，检测是否需要退出
-            except asyncio.CancelledError:
-                self.log.info("发送消息循环收到取消信号，退出")
-                break
-            except Exception as e:
-                self.log.error(f"处理发送队列消息错误: {e}")
-                # 异常场景也向bot回传错误信息
-                error_result = {"status": "error", "message": f"处理消息失败: {str(e)}"}
-                await self.send_response_queue.put(error_result)
+                lane, key, init_payload = await self.outbound.next()
+            except BaseException:
+                self._send_slots.release()
+                raise
+            task = asyncio.create_task(self._send_scheduled(lane, key, init_payload))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _send_scheduled(self, lane: int, key, init_payload: dict):
+        # 通知等待方消息已从调度器发出，其响应超时从此刻开始计算
+        dispatched = init_payload.get("dispatched")
+        if dispatched is not None:
+            dispatched.set()
+        try:
+            await self._send_one(init_payload)
+        finally:
+            self._send_slots.release()
+            self._pending_slots.release()
+            self.outbound.done(lane, key)
+
+    async def _send_one(self, init_payload: dict):
+        """发送一条消息，并把发送结果回传给bot"""
+        payload = init_payload.get("payload", {})
+        try:
+            # 区分使用哪种发送方式处理payload
+            if init_payload["send_type"] == "websocket":
+                send_result = await self.websocket_send(payload)
+            elif init_payload["send_type"] == "http":
+                send_result = await self.http_send(payload)
+            else:
+                self.log.warning(f"未知的send_type类型：{init_payload['send_type']}")
+                send_result = {"status": "error", "message": f"未知的send_type: {init_payload['send_type']}"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error(f"处理发送队列消息错误: {e}")
+            # 异常场景也向bot回传错误信息
+            send_result = {"status": "error", "message": f"处理消息失败: {str(e)}"}
+
+        # 将发送结果回传给bot（补充关联原消息的标识，方便bot匹配）
+        if send_result is not None:
+            send_result["request_echo"] = payload.get("echo", "")
+            await self.send_response_queue.put(send_result)
 
     async def websocket_send(self, payload: dict) -> dict:
         """通过websocket向napcat发送消息，返回发送结果"""
@@ -91,12 +301,17 @@ class Adapter:
             # 检查空id
             if not request_uuid:
                 return {}
-            # 检查活跃连接
-            if not self.active_connections:
-                raise RuntimeError("无可用的websocket活跃连接")
-
-            conn = next(iter(self.active_connections))
-            await conn.send(json.dumps(payload, ensure_ascii=False))
+            # 按账号选择连接
+            conn = self.route_connection(payload)
+            # self_id仅用于路由，不发送给napcat
+            body = {key: value for key, value in payload.items() if key != "self_id"}
+            # 先登记再发送，保证响应到达时一定能找到对应的Future
+            self.register_response(request_uuid)
+            try:
+                await conn.send(json_codec.dumps(body))
+            except Exception:
+                self.pending_responses.pop(request_uuid, None)
+                raise
             # 获取消息响应
             response = await self.get_response(request_uuid)
             if response.get("status") == "ok":
@@ -113,25 +328,38 @@ class Adapter:
             return {"status": "error", "message": str(e), "echo": request_uuid}
 
     async def http_send(self, payload: dict) -> dict:
-        """通过HTTP向napcat发送消息，返回发送结果"""
-        # 定义超时时间，避免无限等待
-        timeout = aiohttp.ClientTimeout(total=60)
+        """通过HTTP向napcat发送消息，返回发送结果（复用共享会话，幂等action失败时按指数退避重试）"""
+        action = payload.get("action")
         try:
-            # 提取action并拼接URL
-            action = payload.pop("action")
-            url = f"http://{self.http_server_ip}:{self.http_server_port}/{action}"
-
-            # 异步发送POST请求
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url=url, json=payload) as response:
-                    res_data = await response.json()
-
-                    if res_data.get("status") == "ok":
-                        self.log.info(f"HTTP消息发送成功（action: {action}）")
-                    else:
-                        self.log.warning(
-                            f"HTTP消息发送失败（action: {action}），napcat返回：{json.dumps(res_data, ensure_ascii=False)[:300]}......")
-                    return res_data
+            # 请求体不包含action，复制一份，不修改调用方的payload
+            body = {key: value for key, value in payload.items() if key not in ("action", "self_id")}
+            url = f"http://{self.route_http_server(payload)}/{action}"
+            timeout = aiohttp.ClientTimeout(total=self.http_action_timeouts.get(action, self.http_timeout))
+            retries = self.http_retries if action in self.http_retry_actions else 0
+            session = await self.open_http_session()
+
+            for attempt in range(retries + 1):
+                try:
+                    async with session.post(url=url, json=body, timeout=timeout) as response:
+                        if response.status >= 500 and attempt < retries:
+                            raise aiohttp.ClientResponseError(
+                                response.request_info, response.history, status=response.status
+                            )
+                        res_data = await response.json()
+                    break
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+                    if attempt >= retries:
+                        raise
+                    delay = self.http_retry_backoff * (2 ** attempt)
+                    self.log.warning(f"HTTP请求失败（action: {action}），{delay:.1f}秒后第{attempt + 1}次重试：{e!r}")
+                    await asyncio.sleep(delay)
+
+            if res_data.get("status") == "ok":
+                self.log.info(f"HTTP消息发送成功（action: {action}）")
+            else:
+                self.log.warning(
+                    f"HTTP消息发送失败（action: {action}），napcat返回：{json.dumps(res_data, ensure_ascii=False)[:300]}......")
+            return res_data
 
         except asyncio.TimeoutError:
             self.log.error(f"HTTP发送消息超时（action: {action}）")
@@ -149,30 +377,68 @@ class Adapter:
     async def message_recv(self, server_connection: Server.ServerConnection):
         """接收napcat的websocket消息，分发到对应队列"""
         self.active_connections.add(server_connection)
+        # napcat连接时在请求头中带上账号（X-Self-ID），没有时从之后的事件中获取
+        request = getattr(server_connection, "request", None)
+        if request is not None:
+            self.register_connection(server_connection, request.headers.get("X-Self-ID"))
         try:
             async for raw_message in server_connection:
-                # 日志截断过长消息
-                log_msg = raw_message[:100] + "..." if len(raw_message) > 100 else raw_message
-                self.log.info(f"收到napcat消息：{log_msg}")
+                if isinstance(raw_message, bytes):
+                    raw_message = raw_message.decode("utf-8", errors="replace")
+                # 快速通道：已知账号的心跳/生命周期帧只计数，不做完整解析
+                meta_type = self._prefilter_meta_event(raw_message)
+                if meta_type is not None and server_connection in self.connection_ids:
+                    self.frame_counts[meta_type] += 1
+                    continue
+                if self.log.isEnabledFor(logging.DEBUG):
+                    # 日志截断过长消息
+                    log_msg = raw_message[:100] + "..." if len(raw_message) > 100 else raw_message
+                    self.log.debug(f"收到napcat消息：{log_msg}")
 
-                decoded_raw_message: dict = json.loads(raw_message)
+                try:
+                    decoded_raw_message: dict = json_codec.loads(raw_message)
+                except ValueError as e:
+                    # 单帧解析失败不影响连接上的后续消息
+                    self.frame_counts["invalid"] += 1
+                    self.log.error(f"消息JSON解析失败：{e}，原始消息：{raw_message[:200]}")
+                    continue
+                self.frame_counts["decoded"] += 1
                 post_type = decoded_raw_message.get("post_type")
+                if "self_id" in decoded_raw_message:
+                    self.register_connection(server_connection, decoded_raw_message["self_id"])
 
                 # 普通消息：转发给bot
                 if post_type in ["message"]:
+                    group_id = decoded_raw_message.get("group_id")
+                    self_id = self.connection_ids.get(server_connection)
+                    if group_id is not None and self_id is not None:
+                        # 多个账号在同一个群时，只处理负责该群的账号收到的消息，避免重复处理
+                        owner = self.assign_group_owner(int(group_id), self_id)
+                        if owner != self_id:
+                            self.log.debug(f"群{group_id}由账号{owner}负责，忽略账号{self_id}收到的重复消息")
+                            continue
+                    # 附上所有在线的bot账号：群里@的是其他bot账号时也要识别为@bot（事件只来自负责该群的账号）
+                    decoded_raw_message["bot_self_ids"] = list(self.connections)
                     await self.message_queue.put(decoded_raw_message)
-                # 响应类消息：存入临时队列供get_response匹配
+                # 响应类消息：唤醒等待该echo的请求
                 elif post_type is None:
                     await self.put_response(decoded_raw_message)
-        except json.JSONDecodeError as e:
-            self.log.error(f"消息JSON解析失败：{e}，原始消息：{raw_message[:200]}")
         finally:
             self.active_connections.discard(server_connection)
+            self.unregister_connection(server_connection)
+
+    @staticmethod
+    def _prefilter_meta_event(raw_message: str) -> str | None:
+        """不解析JSON判断是否为元事件帧，返回heartbeat/lifecycle，其他帧返回None"""
+        if not any(marker in raw_message for marker in META_EVENT_MARKERS):
+            return None
+        return "heartbeat" if '"heartbeat"' in raw_message else "lifecycle"
 
     async def start_server(self):
         """启动Adapter服务（websocket服务+消息发送循环）"""
         try:
             self.log.info("正在启动adapter...")
+            await self.open_http_session()
             # 启动websocket服务
             async with Server.serve(self.message_recv, host=self.host, port=self.port) as self.server:
                 self.log.info(f"Adapter已启动，监听地址: ws://{self.host}:{self.port}")
@@ -186,4 +452,5 @@ class Adapter:
                 self.server.close()
                 await self.server.wait_closed()
         finally:
+            await self.close_http_session()
             self.log.info("Adapter服务已关闭")
\ No newline at end of file
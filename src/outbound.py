@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable
+
+from utils.rate_limit import TokenBucket
+
+# 发送通道（数字越小越优先）：文本回复优先于文件上传等大件发送
+LANE_TEXT = 0
+LANE_BULK = 1
+LANE_NAMES = {LANE_TEXT: "text", LANE_BULK: "bulk"}
+BULK_SEGMENTS = {"file", "video", "record"}
+
+
+def action_params(payload: dict) -> dict:
+    """action的参数：websocket格式在params中，HTTP格式直接在payload顶层"""
+    params = payload.get("params")
+    return params if isinstance(params, dict) else payload
+
+
+class OutboundScheduler:
+    """
+    :出站消息调度
+    :argument 每个群一个令牌桶、每个账号一个令牌桶，避免超过QQ的发送频率被限流/吞消息（多账号时各账号分别限流）
+    :argument 同一个群同一通道内严格按顺序发送（上一条完成后才发下一条）；文本通道优先于文件通道，同一通道内各群轮流
+    :argument 记录各通道的排队等待时间
+    """
+
+    def __init__(self, cfg, log, account_of: Callable[[Any], Any] = None):
+        """
+        :param account_of: 分组 -> 负责发送的账号，未提供或返回None时归入默认账号
+        """
+        self.log = log
+        self.account_of = account_of or (lambda key: None)
+        self.group_rate = cfg.get("outbound", "group_rate", 1)  # 每个群每秒最多发送的消息数，<=0不限
+        self.group_burst = cfg.get("outbound", "group_burst", 3)
+        self.global_rate = cfg.get("outbound", "global_rate", 5)  # 每个账号每秒最多发送的消息数，<=0不限
+        self.global_burst = cfg.get("outbound", "global_burst", 10)
+        self.group_buckets: dict = {}  # 群 -> 令牌桶
+        self.account_buckets: dict = {}  # 账号 -> 令牌桶
+        # 通道 -> (群 -> 待发送的(入队时间, payload))，OrderedDict用于群间轮转
+        self.lanes: dict[int, OrderedDict] = {lane: OrderedDict() for lane in LANE_NAMES}
+        self.inflight: set = set()  # 正在发送的(通道, 群)
+        self.wait_stats: dict[int, dict] = {lane: {"count": 0, "total": 0.0, "max": 0.0} for lane in LANE_NAMES}
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def order_key(init_payload: dict):
+        """发送顺序的分组：群消息按群号，其他消息按echo（互不等待）"""
+        payload = init_payload.get("payload", {})
+        group_id = action_params(payload).get("group_id")
+        if group_id is not None:
+            return "group", int(group_id)
+        return "echo", payload.get("echo") or uuid.uuid4().hex
+
+    @staticmethod
+    def lane_of(init_payload: dict) -> int:
+        """文件/视频/语音消息和upload类action走大件通道，其余走文本通道"""
+        payload = init_payload.get("payload", {})
+        if str(payload.get("action", "")).startswith("upload"):
+            return LANE_BULK
+        message = action_params(payload).get("message")
+        if isinstance(message, list) and any(
+            isinstance(segment, dict) and segment.get("type") in BULK_SEGMENTS for segment in message
+        ):
+            return LANE_BULK
+        return LANE_TEXT
+
+    def put(self, init_payload: dict):
+        key = self.order_key(init_payload)
+        lane = self.lane_of(init_payload)
+        self.lanes[lane].setdefault(key, deque()).append((time.monotonic(), init_payload))
+        self._wakeup.set()
+
+    def done(self, lane: int, key):
+        """一条消息发送完成（无论成功与否），放行该群该通道的下一条"""
+        self.inflight.discard((lane, key))
+        self._wakeup.set()
+
+    async def next(self) -> tuple[int, object, dict]:
+        """等待并取出下一条可以发送的消息，返回(通道, 群, payload)"""
+        while True:
+            self._wakeup.clear()
+            item, wait = self._pick()
+            if item is not None:
+                return item
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def depth(self) -> dict:
+        return {LANE_NAMES[lane]: sum(len(queue) for queue in groups.values()) for lane, groups in self.lanes.items()}
+
+    def metrics(self) -> dict:
+        """调度指标：各通道积压数、在途数、排队等待时间（秒）"""
+        return {
+            "depth": self.depth(),
+            "inflight": len(self.inflight),
+            "wait": {
+                LANE_NAMES[lane]: {
+                    "count": stat["count"],
+                    "avg": stat["total"] / stat["count"] if stat["count"] else 0,
+                    "max": stat["max"],
+                }
+                for lane, stat in self.wait_stats.items()
+            },
+        }
+
+    def _group_bucket(self, key) -> TokenBucket | None:
+        if key[0] != "group":
+            return None
+        bucket = self.group_buckets.get(key)
+        if bucket is None:
+            bucket = self.group_buckets[key] = TokenBucket(rate=self.group_rate, capacity=self.group_burst)
+        return bucket
+
+    def _account_bucket(self, key) -> TokenBucket:
+        account = self.account_of(key)
+        bucket = self.account_buckets.get(account)
+        if bucket is None:
+            bucket = self.account_buckets[account] = TokenBucket(rate=self.global_rate, capacity=self.global_burst)
+        return bucket
+
+    def _pick(self):
+        """按通道优先级、群间轮转选出一条满足限流和顺序要求的消息；都不满足时返回(None, 最短等待秒数)"""
+        min_wait = None
+        for lane, groups in self.lanes.items():
+            for key in list(groups):
+                if (lane, key) in self.inflight:
+                    continue
+                bucket = self._group_bucket(key)
+                account_bucket = self._account_bucket(key)
+                wait = max(account_bucket.wait_time(1), bucket.wait_time(1) if bucket else 0)
+                if wait > 0:
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+                    continue
+                queue = groups[key]
+                enqueue_time, init_payload = queue.popleft()
+                if queue:
+                    groups.move_to_end(key)
+                else:
+                    del groups[key]
+                if bucket:
+                    bucket.consume(1)
+                account_bucket.consume(1)
+                self.inflight.add((lane, key))
+                self._record_wait(lane, key, time.monotonic() - enqueue_time)
+                return (lane, key, init_payload), None
+        return None, min_wait
+
+    def _record_wait(self, lane: int, key, wait: float):
+        stat = self.wait_stats[lane]
+        stat["count"] += 1
+        stat["total"] += wait
+        stat["max"] = max(stat["max"], wait)
+        if wait > 5:
+            self.log.debug(f"出站消息排队{wait:.2f}秒（通道{LANE_NAMES[lane]}，{key}），当前积压：{self.depth()}")
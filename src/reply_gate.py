@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import random
+from typing import Callable
+
+# 评分函数：参数为(门控对象, 未处理的消息元数据列表)，返回(得分, 依据)，得分为0表示不影响
+Scorer = Callable[["ReplyGate", list], tuple[float, str]]
+
+QUESTION_WORDS = ("吗", "呢", "怎么", "为什么", "什么", "谁", "哪", "几", "多少", "?", "？")
+
+
+def mention_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """@bot或提及bot的名字"""
+    if any(meta.get("mentioned") for meta in unread):
+        return gate.direct_score, "提及bot"
+    return 0, ""
+
+
+def reply_to_self_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """回复了bot自己发出的消息"""
+    if any(meta.get("reply_to_self") for meta in unread):
+        return gate.direct_score, "回复bot的消息"
+    return 0, ""
+
+
+def question_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """包含提问"""
+    if any(word in meta.get("text", "") for meta in unread for word in QUESTION_WORDS):
+        return 1, "有提问"
+    return 0, ""
+
+
+def keyword_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """包含配置的关键词"""
+    for meta in unread:
+        for keyword in gate.keywords:
+            if keyword in meta.get("text", ""):
+                return 2, f"关键词{keyword}"
+    return 0, ""
+
+
+def noise_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """纯图片/表情包、单字刷屏、复读等噪声消息"""
+    texts = [meta.get("text", "").strip() for meta in unread]
+    if all(len(text) <= 1 for text in texts):
+        return -3, "纯表情包/单字消息"
+    if len(texts) >= 3 and len(set(texts)) == 1:
+        return -3, "复读"
+    return 0, ""
+
+
+def rate_scorer(gate: "ReplyGate", unread: list) -> tuple[float, str]:
+    """短时间内大量消息（群友之间在快速聊天），降低插话意愿"""
+    times = [meta["time"] for meta in unread if "time" in meta]
+    if len(times) >= 5 and (times[-1] - times[0]) / (len(times) - 1) < gate.busy_gap:
+        return -1, "消息刷屏中"
+    return 0, ""
+
+
+class ReplyGate:
+    """
+    :回复门控：调用LLM生成决策前的本地预筛选
+    :argument 对未处理的消息逐项评分：得分达到gate_reply_score直接回复，不高于gate_skip_score直接跳过，其余按probability_reply（随得分微调）概率回复
+    :argument 评分函数可通过register追加，每次门控结果都会记录日志便于调参
+    """
+
+    DEFAULT_SCORERS: list[Scorer] = [
+        mention_scorer,
+        reply_to_self_scorer,
+        question_scorer,
+        keyword_scorer,
+        noise_scorer,
+        rate_scorer,
+    ]
+
+    def __init__(self, cfg, log, scorers: list[Scorer] = None):
+        self.cfg = cfg
+        self.log = log
+        self.scorers: list[Scorer] = list(scorers if scorers is not None else self.DEFAULT_SCORERS)
+        self.direct_score = 10  # @bot/回复bot消息的得分，确保一定回复
+        self.keywords: list = cfg.get("setup", "gate_keywords", [])
+        self.busy_gap = cfg.get("setup", "gate_busy_gap", 1.0)  # 平均间隔小于该秒数视为刷屏
+
+    def register(self, scorer: Scorer):
+        """追加自定义评分函数"""
+        self.scorers.append(scorer)
+
+    def should_reply(self, unread: list, group_id=None) -> bool:
+        """
+        :param unread: 自上次决策以来的消息元数据列表（text/mentioned/reply_to_self/time）
+        :param group_id: 群ID，仅用于日志
+        :return: 是否调用LLM生成决策
+        """
+        if not self.cfg.get("setup", "reply_gate", True):
+            return random.random() < self.cfg.get("setup", "probability_reply")
+        score = 0
+        reasons = []
+        if unread:
+            for scorer in self.scorers:
+                try:
+                    scorer_score, reason = scorer(self, unread)
+                except Exception as e:
+                    self.log.warning(f"回复门控评分函数{getattr(scorer, '__name__', scorer)}出错：{e}")
+                    continue
+                if scorer_score:
+                    score += scorer_score
+                    reasons.append(f"{reason}({scorer_score:+g})")
+        if score >= self.cfg.get("setup", "gate_reply_score", 5):
+            result, mode = True, "直接回复"
+        elif score <= self.cfg.get("setup", "gate_skip_score", -2):
+            result, mode = False, "直接跳过"
+        else:
+            # 中间分数：在原回复概率上按得分微调，得分为0时与原概率一致
+            probability = self.cfg.get("setup", "probability_reply") + score * self.cfg.get("setup", "gate_score_step", 0.1)
+            probability = min(max(probability, 0), 1)
+            result, mode = random.random() < probability, f"概率回复({probability:.2f})"
+        self.log.info(
+            f"回复门控：群{group_id} 消息{len(unread)}条 得分{score:g} 依据[{'、'.join(reasons) or '无'}] {mode} -> {'回复' if result else '不回复'}"
+        )
+        return result
@@ -0,0 +1,95 @@
+import asyncio
+from typing import Any, Callable, Hashable
+
+# 队列满时的处理策略
+POLICY_BLOCK = "block"  # 等待队列有空位（生产者暂停，如暂停读取websocket）
+POLICY_DROP_NEW = "drop_new"  # 丢弃新到的项
+POLICY_DROP_OLDEST = "drop_oldest"  # 丢弃最旧的可丢弃项（优先丢弃同一分组的），受保护的项尽量保留
+POLICIES = (POLICY_BLOCK, POLICY_DROP_NEW, POLICY_DROP_OLDEST)
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    :有界队列，队列满时按策略阻塞或丢弃，并按原因统计丢弃数
+    :argument drop_oldest策略下，protected返回True的项（如@bot的消息）只有在队列中全是受保护项时才会被丢弃
+    :argument 每项的受保护标记和分组在入队时计算一次，与项一起保存，选择丢弃项时不再对整个队列重复调用
+    """
+
+    def __init__(self, maxsize: int, policy: str = POLICY_BLOCK, name: str = "", log=None,
+                 protected: Callable[[Any], bool] = None, group_of: Callable[[Any], Hashable] = None):
+        """
+        :param maxsize: 队列容量，<=0表示不限（此时不会丢弃）
+        :param policy: block/drop_new/drop_oldest
+        :param name: 队列名称，仅用于日志
+        :param protected: 判断项是否受保护（尽量不丢弃）
+        :param group_of: 项所属的分组（如群号），drop_oldest时优先丢弃与新项同组的最旧项
+        """
+        super().__init__(maxsize=maxsize)
+        if policy not in POLICIES:
+            policy = POLICY_BLOCK
+        self.policy = policy
+        self.name = name
+        self.log = log
+        self.protected = protected or (lambda item: False)
+        self.group_of = group_of
+        self.shed: dict[str, int] = {}  # 丢弃原因 -> 次数
+        self.blocked = 0  # block策略下生产者因队列满而等待的次数
+
+    async def put(self, item: Any):
+        if self.policy == POLICY_BLOCK:
+            if self.full():
+                self.blocked += 1
+            return await super().put(item)
+        self.put_nowait(item)
+
+    def put_nowait(self, item: Any):
+        """队列满时按策略丢弃（block策略与asyncio.Queue一致，抛出QueueFull）"""
+        if not self.full() or self.policy == POLICY_BLOCK:
+            return super().put_nowait(item)
+        if self.policy == POLICY_DROP_NEW:
+            self._count_shed("full_drop_new")
+            return
+        protected = self.protected(item)
+        index = self._find_victim(self.group_of(item) if self.group_of else None)
+        if index is None:
+            if not protected:
+                # 队列中全是受保护的项，新项可丢弃
+                self._count_shed("full_of_protected")
+                return
+            index = 0
+            self._count_shed("protected_overflow")
+        else:
+            self._count_shed("drop_oldest")
+        del self._queue[index]
+        # 被丢弃的项视为已处理，保持join()的计数正确
+        self.task_done()
+        super().put_nowait(item)
+
+    def metrics(self) -> dict:
+        return {"size": self.qsize(), "maxsize": self.maxsize, "shed": dict(self.shed), "blocked": self.blocked}
+
+    # asyncio.Queue的存取钩子：队列中保存(项, 是否受保护, 分组)
+    def _put(self, item: Any):
+        self._queue.append((item, self.protected(item), self.group_of(item) if self.group_of else None))
+
+    def _get(self) -> Any:
+        return self._queue.popleft()[0]
+
+    def _find_victim(self, group: Hashable | None) -> int | None:
+        """找出最旧的可丢弃项的位置：优先与新项同组（group），其次任意组"""
+        fallback = None
+        for index, (_, protected, queued_group) in enumerate(self._queue):
+            if protected:
+                continue
+            if group is None or queued_group == group:
+                return index
+            if fallback is None:
+                fallback = index
+        return fallback
+
+    def _count_shed(self, reason: str):
+        count = self.shed.get(reason, 0) + 1
+        self.shed[reason] = count
+        # 首次及之后每100次记录一次，避免过载时日志本身成为负担
+        if self.log and (count == 1 or count % 100 == 0):
+            self.log.warning(f"队列{self.name}已满（{self.maxsize}），按{self.policy}策略丢弃（{reason}），累计{count}次")
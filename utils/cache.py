@@ -0,0 +1,86 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """带过期时间的LRU缓存（超过容量淘汰最久未使用的项，超过ttl的项读取时视为不存在）"""
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        """
+        :param max_size: 最大缓存条目数
+        :param ttl: 条目存活时间（秒），<=0表示永不过期
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, self._MISSING)
+        if item is self._MISSING:
+            self.misses += 1
+            return default
+        expire_at, value = item
+        if self.ttl > 0 and expire_at < time.monotonic():
+            # 过期项惰性删除
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self._MISSING) is not self._MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class InflightDedup:
+    """合并并发的相同请求：同一个key同时只执行一次，其他调用方共享同一个结果"""
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        :param key: 请求的唯一标识
+        :param factory: 真正执行请求的协程工厂，仅在该key没有进行中的请求时调用
+        :return: 请求结果（异常同样会传递给所有等待者）
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            # shield：某个等待者被取消不影响其他等待者
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(factory())
+        self._inflight[key] = future
+        future.add_done_callback(lambda done: self._on_done(key, done))
+        return await asyncio.shield(future)
+
+    def _on_done(self, key: Hashable, future: asyncio.Future):
+        self._inflight.pop(key, None)
+        # 取出异常，避免所有等待者都已取消时出现“exception was never retrieved”
+        if not future.cancelled():
+            future.exception()
@@ -1,70 +1,113 @@
+import asyncio
 import configparser
 import os
 import json  # 新增：导入json模块
+import logging
+from types import MappingProxyType
 from typing import Any, Optional
 
+_MISSING = object()
+_logger = logging.getLogger(__name__)  # 未传入log时使用
+
+
+def _freeze(value: Any) -> Any:
+    """把list/dict转换为不可变的tuple/只读映射，保证快照不会被调用方修改"""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    return value
+
+
+def parse_value(value: str) -> Any:
+    """
+    按原有规则转换配置值的类型：JSON的list/dict > bool > int > float > str
+    """
+    # 先去除首尾空格（避免JSON字符串前后空格导致解析失败）
+    value = value.strip()
+    # 先尝试解析JSON，支持list/dict/嵌套复杂类型
+    try:
+        json_value = json.loads(value)
+        # 仅当解析结果是list或dict时返回，避免将JSON格式的数字/布尔值误解析
+        if isinstance(json_value, (list, dict)):
+            return _freeze(json_value)
+    except json.JSONDecodeError:
+        # 非JSON格式，继续走原有类型转换逻辑
+        pass
+    # 布尔值（true/false，不区分大小写）
+    if value.lower() in ["true", "false"]:
+        return value.lower() == "true"
+    # 整数
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    # 浮点数
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # 字符串（默认）
+    return value
+
 
 class ConfigManager:
-    """简单实用的配置管理类（基于ini文件，扩展支持List/Dict类型）"""
+    """
+    简单实用的配置管理类（基于ini文件，扩展支持List/Dict类型）
+    整个文件只解析一次，生成类型已转换的只读快照，get为O(1)的字典查找；
+    文件修改后可通过reload/watch热重载：新文件解析成功后整体替换快照，解析失败则保留旧配置
+    """
 
     def __init__(self, config_file: str = "config.ini"):
         """
         初始化配置管理器
         :param config_file: 配置文件路径，默认项目根目录的config.ini
         """
-        self.config = configparser.ConfigParser(interpolation=None)
         self.config_file = config_file
 
         # 检查配置文件是否存在，不存在则抛出明确异常
         if not os.path.exists(config_file):
             raise FileNotFoundError(f"配置文件 {config_file} 不存在，请检查路径！")
 
-        # 读取配置文件（支持中文）
-        self.config.read(config_file, encoding="utf-8")
+        self.config, self._snapshot, self._sections = self._load()
+        self._mtime = os.path.getmtime(config_file)  # 最近一次成功加载的文件修改时间
+        self._last_error = None  # 最近一次重载失败的原因，相同的失败只报告一次
+        self.version = 1  # 每次成功重载加1
+
+    def _load(self) -> tuple[configparser.ConfigParser, MappingProxyType, MappingProxyType]:
+        """读取并解析整个配置文件，返回(原始解析器, (节, 键)->值的快照, 节->该节键列表)"""
+        config = configparser.ConfigParser(interpolation=None)
+        # 读取配置文件（支持中文），格式错误时抛出configparser.Error
+        with open(self.config_file, encoding="utf-8") as f:
+            config.read_file(f)
+        snapshot = {}
+        sections = {}
+        for section in config.sections():
+            keys = []
+            for key, value in config[section].items():
+                snapshot[(section, key)] = parse_value(value)
+                keys.append(key)
+            sections[section] = tuple(keys)
+        return config, MappingProxyType(snapshot), MappingProxyType(sections)
 
     def get(self, section: str, key: str, default: Any = None) -> Any:
         """
-        读取通用配置项（自动处理类型：bool/int/float/str/list/dict，支持嵌套）
+        读取通用配置项（类型已在加载时转换：bool/int/float/str/list/dict，list/dict为只读的tuple/映射）
         :param section: 配置节（如database、logging）
         :param key: 配置键
-        :param default: 配置缺失时的默认值（支持list/dict类型）
-        :return: 配置值（自动转换为对应类型）
+        :param default: 配置缺失时的默认值（支持list/dict类型默认值）
+        :return: 配置值
         """
-        try:
-            # 先尝试读取原始值并去除首尾空格（避免JSON字符串前后空格导致解析失败）
-            value = self.config.get(section, key).strip()
-
-            # 核心新增：先尝试解析JSON，支持list/dict/嵌套复杂类型
-            try:
-                json_value = json.loads(value)
-                # 仅当解析结果是list或dict时返回，避免将JSON格式的数字/布尔值误解析
-                if isinstance(json_value, (list, dict)):
-                    return json_value
-            except json.JSONDecodeError:
-                # 非JSON格式，继续走原有类型转换逻辑
-                pass
-
-            # 原有自动类型转换逻辑（保持不变）
-            # 布尔值（true/false，不区分大小写）
-            if value.lower() in ["true", "false"]:
-                return value.lower() == "true"
-            # 整数
-            try:
-                return int(value)
-            except ValueError:
-                pass
-            # 浮点数
-            try:
-                return float(value)
-            except ValueError:
-                pass
-            # 字符串（默认）
+        value = self._snapshot.get((section, key), _MISSING)
+        if value is _MISSING:
+            # ini的键不区分大小写（解析时统一转为小写）
+            value = self._snapshot.get((section, key.lower()), _MISSING)
+        if value is not _MISSING:
             return value
-        except (configparser.NoSectionError, configparser.NoOptionError):
-            # 配置缺失时返回默认值（支持list/dict类型默认值）
-            if default is not None:
-                return default
-            raise KeyError(f"配置项 [{section}] {key} 不存在，且未设置默认值！")
+        # 配置缺失时返回默认值（支持list/dict类型默认值）
+        if default is not None:
+            return default
+        raise KeyError(f"配置项 [{section}] {key} 不存在，且未设置默认值！")
 
     def get_section(self, section: str) -> dict:
         """
@@ -72,13 +115,65 @@ class ConfigManager:
         :param section: 配置节名称
         :return: 该节的所有配置项（键值对，含自动类型转换后的list/dict）
         """
-        if section not in self.config.sections():
+        if section not in self._sections:
             raise KeyError(f"配置节 [{section}] 不存在！")
-        # 转换为字典并自动处理类型（继承get方法的list/dict解析能力）
-        section_dict = {}
-        for key, value in self.config[section].items():
-            section_dict[key] = self.get(section, key)
-        return section_dict
+        return {key: self._snapshot[(section, key)] for key in self._sections[section]}
+
+    def reload(self, log=None) -> bool:
+        """
+        重新解析配置文件并原子替换快照
+        :校验：文件可解析，且原有的配置节都还在（避免编辑到一半的文件生效）；校验失败时保留旧配置
+        :return: 是否已替换
+        """
+        try:
+            config, snapshot, sections = self._load()
+        except Exception as e:
+            # 包括OSError、configparser.Error以及文件编码错误（UnicodeDecodeError）等
+            self._report_error(log, f"配置文件 {self.config_file} 解析失败，继续使用旧配置：{e}")
+            return False
+        missing = [section for section in self._sections if section not in sections]
+        if missing:
+            self._report_error(log, f"配置文件 {self.config_file} 缺少配置节{missing}，继续使用旧配置")
+            return False
+        changed = [f"[{section}] {key}" for (section, key), value in snapshot.items()
+                   if self._snapshot.get((section, key), _MISSING) != value]
+        changed += [f"[{section}] {key}（已删除）" for section, key in self._snapshot if (section, key) not in snapshot]
+        # 一次赋值完成替换，读取方要么看到旧快照，要么看到新快照
+        self.config, self._snapshot, self._sections = config, snapshot, sections
+        self.version += 1
+        self._last_error = None
+        self._report(log, f"配置文件已重新加载（版本{self.version}），变更项：{changed or '无'}", warning=False)
+        return True
+
+    async def watch(self, interval: float = 2, log=None):
+        """
+        后台任务：按间隔检查配置文件的修改时间，变化时热重载
+        只有重载成功后才记录新的修改时间，失败时下次检查继续重试（如文件尚未写完）；任何异常都不会结束该任务
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.path.getmtime(self.config_file)
+                if mtime != self._mtime and self.reload(log):
+                    self._mtime = mtime
+            except OSError:
+                continue
+            except Exception as e:
+                self._report(log, f"检查配置文件 {self.config_file} 失败：{e}")
+
+    def _report_error(self, log, msg: str):
+        """报告重载失败，与上次相同的失败不重复报告（watch会持续重试）"""
+        if msg != self._last_error:
+            self._last_error = msg
+            self._report(log, msg)
+
+    @staticmethod
+    def _report(log, msg: str, warning: bool = True):
+        log = log or _logger
+        if warning:
+            log.warning(msg)
+        else:
+            log.info(msg)
 
 # ------------------- 测试使用示例 -------------------
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import json
+from typing import Any, Callable
+
+# 可选依赖：安装了orjson时默认使用（解析/序列化速度明显快于标准库json）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _orjson_dumps(obj: Any) -> str:
+    return orjson.dumps(obj).decode("utf-8")
+
+
+CODECS: dict[str, tuple[Callable[[str | bytes], Any], Callable[[Any], str]]] = {
+    "json": (json.loads, _json_dumps),
+}
+if orjson is not None:
+    CODECS["orjson"] = (orjson.loads, _orjson_dumps)
+
+# 解析失败时抛出的异常（orjson.JSONDecodeError是json.JSONDecodeError的子类）
+DecodeError = json.JSONDecodeError
+
+codec_name = "orjson" if orjson is not None else "json"
+loads, dumps = CODECS[codec_name]
+
+
+def use_codec(name: str):
+    """
+    :切换全局使用的JSON编解码器
+    :param name: json/orjson，未安装的编解码器退回标准库json
+    """
+    global codec_name, loads, dumps
+    if name not in CODECS:
+        name = "json"
+    codec_name = name
+    loads, dumps = CODECS[name]
+
+
+def register_codec(name: str, decode: Callable[[str | bytes], Any], encode: Callable[[Any], str]):
+    """注册自定义编解码器（decode失败时应抛出json.JSONDecodeError或ValueError）"""
+    CODECS[name] = (decode, encode)
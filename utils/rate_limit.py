@@ -0,0 +1,42 @@
+import time
+
+
+class TokenBucket:
+    """令牌桶限流（按秒连续补充令牌，容量即允许的突发量）"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: 每秒补充的令牌数，<=0表示不限流
+        :param capacity: 桶容量，默认等于rate（即最多突发1秒的量）
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @classmethod
+    def per_minute(cls, amount: float) -> "TokenBucket":
+        """按“每分钟amount个”构建（如RPM/TPM），容量为一分钟的量"""
+        return cls(rate=amount / 60, capacity=amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float = 1) -> float:
+        """获取amount个令牌还需等待的秒数，0表示当前即可获取"""
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        amount = min(amount, self.capacity)  # 超过容量的请求按容量计，避免永远等待
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float = 1):
+        """扣除令牌（允许透支，透支部分由后续补充抵消）"""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens -= min(amount, self.capacity)